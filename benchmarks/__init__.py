@@ -0,0 +1,98 @@
+"""
+Helpers for driving MineBNC's protocols in memory, without sockets. Run the
+benchmarks from the repository root, with a ``config.py`` in place, e.g.::
+
+    $ python -m benchmarks.dispatch
+"""
+
+import time
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+
+from quarry.net.auth import OfflineProfile
+from quarry.types.chunk import BlockArray, LightArray
+
+import minebnc
+import plugins.chat
+
+# Benchmarks shouldn't leave chat logs or packet traces behind
+minebnc.trace_path = None
+plugins.chat.chat_log_path = None
+
+
+def make_upstream():
+    """
+    Returns an ``Upstream`` in "play" mode with its plugins loaded and an
+    in-memory transport, belonging to a new session.
+    """
+
+    session = minebnc.Session(OfflineProfile("benchmark"), "127.0.0.1", 25565)
+    factory = session.factory
+    upstream = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    session.upstream = upstream
+    upstream.ticker.stop()
+    upstream.transport = StringTransport()
+    upstream.protocol_version = factory.force_protocol_version
+    upstream.buff_type = factory.get_buff_type(upstream.protocol_version)
+    upstream.protocol_mode = "play"
+    upstream.load_plugins()
+    return upstream
+
+
+def make_downstream():
+    """
+    Returns a ``Downstream`` in "play" mode with an in-memory transport.
+    """
+
+    factory = minebnc.DownstreamFactory()
+    downstream = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 0))
+    downstream.ticker.stop()
+    downstream.transport = StringTransport()
+    downstream.protocol_version = factory.force_protocol_version
+    downstream.buff_type = factory.get_buff_type(downstream.protocol_version)
+    downstream.protocol_mode = "play"
+    return downstream
+
+
+def get_plugin(upstream, name):
+    """
+    Returns the upstream's plugin with the given class name.
+    """
+
+    for plugin in upstream.plugins:
+        if type(plugin).__name__ == name:
+            return plugin
+
+
+def pack_chunk(bt, x, z, sections=8):
+    """
+    Returns a 'Chunk Data' payload for a chunk with some varied terrain.
+    """
+
+    data = []
+    for idx in range(sections):
+        blocks = BlockArray.empty(bt.registry)
+        for n in range(0, 4096, idx + 3):
+            blocks[n] = 1 + (n + x * z) % 12
+        data.append(bt.pack_chunk_section(
+            blocks, LightArray.empty(), LightArray.empty()))
+    data.append(bt.pack('I' * 256, *[1] * 256))
+    data = b"".join(data)
+    return b"".join((
+        bt.pack('ii?', x, z, True),
+        bt.pack_varint((1 << sections) - 1),
+        bt.pack_varint(len(data)),
+        data,
+        bt.pack_varint(0)))
+
+
+def measure(fn, count):
+    """
+    Calls *fn* *count* times and returns the number of calls per second.
+    """
+
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
@@ -0,0 +1,65 @@
+"""
+Measures the cost of attaching a client to a session holding a full view
+distance of chunks, both after every chunk has been modified and after no
+changes at all, and after chunks have been prepared in the background.
+Chunk replay is run to completion without the reactor, and the time taken
+to send the first slice is reported separately.
+"""
+
+import time
+
+from benchmarks import make_upstream, make_downstream, get_plugin, \
+    pack_chunk
+
+
+def replay(world, downstream):
+    """
+    Attaches *downstream* to the world plugin and replays every chunk.
+    Returns the time taken to send the first slice and all chunks.
+    """
+
+    world.set_downstream(downstream)
+    world.set_forwarding(True)
+    start = time.perf_counter()
+    world.attach()
+    replay = world.replays[downstream]
+    replay.call.cancel()
+    world.replay_chunks(replay)
+    first = time.perf_counter() - start
+    while world.replay_chunks(replay):
+        pass
+    total = time.perf_counter() - start
+    world.detach()
+    world.set_forwarding(False)
+    world.set_downstream(None)
+    return first, total
+
+
+def main(radius=10, threshold=256):
+    upstream = make_upstream()
+    upstream.compression_threshold = threshold
+    bt = upstream.buff_type
+    for x in range(-radius, radius + 1):
+        for z in range(-radius, radius + 1):
+            upstream.dispatch_packet(
+                bt(pack_chunk(bt, x, z)), "chunk_data", "downstream")
+    count = (2 * radius + 1) ** 2
+    world = get_plugin(upstream, "WorldPlugin")
+
+    for label in ("modified", "unchanged", "prepared"):
+        if label != "unchanged":
+            for x, z in world.chunks:
+                world.set_block(16 * x, 0, 16 * z, 1)
+        if label == "prepared":
+            while world.get_staleness()[0]:
+                world.prepare()
+        downstream = make_downstream()
+        downstream.compression_threshold = threshold
+        first, total = replay(world, downstream)
+        print("%-10s %d chunks: %8.1f ms first, %8.1f ms total, %d bytes" % (
+            label, count, first * 1000, total * 1000,
+            len(downstream.transport.value())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Compares attaching a client with a packet written per call against
+attaching with output collected into bursts. The session holds a full view
+distance of chunks and a crowd of mobs. The downstream connection is
+uncompressed, as for a client on the same machine, and is measured with and
+without encryption. Encryption is AES/CFB8 and dominates wall time for large
+attaches.
+
+Each attach is measured twice: in memory, counting transport writes and the
+time taken to produce them, then over a loopback TCP connection, counting
+``send()`` system calls and the time until the client has received it all.
+In the second, the reactor runs the chunk replay as it would for a real
+client.
+"""
+
+import os
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, \
+    TCP4ServerEndpoint, connectProtocol
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.testing import StringTransport
+
+from quarry.data import packets
+from quarry.types.uuid import UUID
+
+from benchmarks import make_upstream, make_downstream, get_plugin, \
+    pack_chunk
+
+
+class CountingTransport(StringTransport):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+
+class CountingSocket(object):
+    # Wraps a socket, counting send() system calls
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.sends = 0
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def send(self, data):
+        self.sends += 1
+        return self.socket.send(data)
+
+
+class Receiver(Protocol):
+    # Reads everything sent to the client, firing a Deferred once the
+    # expected number of bytes have arrived
+
+    def __init__(self):
+        self.received = 0
+        self.expected = None
+        self.done = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received >= self.expected and not self.done.called:
+            self.done.callback(time.perf_counter())
+
+
+class ReceiverFactory(Factory):
+    def __init__(self):
+        self.receivers = defer.DeferredQueue()
+
+    def buildProtocol(self, addr):
+        receiver = Receiver()
+        self.receivers.put(receiver)
+        return receiver
+
+
+def populate(upstream, radius, mobs):
+    """
+    Fills the session with a view distance of chunks and a crowd of mobs.
+    Packets that the configured protocol version lacks, such as the tags,
+    recipes and commands added in 1.13, are skipped.
+    """
+
+    bt = upstream.buff_type
+
+    def dispatch(name, data):
+        key = (upstream.protocol_version, "play", "downstream", name)
+        if key in packets.packet_idents:
+            upstream.dispatch_packet(bt(data), name, "downstream")
+
+    dispatch("tags", bt.pack_varint(0) * 3)
+    dispatch("declare_recipes", bt.pack_varint(0))
+    dispatch("declare_commands", bt.pack_varint(1) + bt.pack('b', 0) +
+             bt.pack_varint(0) + bt.pack_varint(0))
+    for x in range(-radius, radius + 1):
+        for z in range(-radius, radius + 1):
+            dispatch("chunk_data", pack_chunk(bt, x, z))
+    for entity_id in range(1, mobs + 1):
+        dispatch("spawn_mob",
+                 bt.pack_varint(entity_id) +
+                 bt.pack_uuid(UUID.random()) +
+                 bt.pack_varint(90) +
+                 bt.pack('ddd', entity_id % 64, 64, entity_id // 64) +
+                 bt.pack('BBBhhh', 0, 0, 0, 0, 0, 0) +
+                 bt.pack('B', 0xff))
+
+
+def attach(upstream, burst, encrypt):
+    """
+    Attaches a new downstream, replaying every chunk. Returns the number of
+    transport writes, the time taken and the bytes written.
+    """
+
+    downstream = make_downstream()
+    downstream.transport = CountingTransport()
+    if encrypt:
+        downstream.cipher.enable(os.urandom(16))
+    downstream.compression_threshold = -1
+    world = get_plugin(upstream, "WorldPlugin")
+
+    start = time.perf_counter()
+    if burst:
+        downstream.begin_burst()
+    for plugin in upstream.plugins:
+        plugin.set_downstream(downstream)
+        plugin.set_forwarding(True)
+        plugin.attach()
+    replay = world.replays[downstream]
+    replay.call.cancel()
+    while world.replay_chunks(replay):
+        pass
+    if burst:
+        downstream.end_burst()
+    elapsed = time.perf_counter() - start
+
+    for plugin in upstream.plugins:
+        plugin.detach()
+        plugin.set_forwarding(False)
+        plugin.set_downstream(None)
+    return (downstream.transport.writes, elapsed,
+            len(downstream.transport.value()))
+
+
+@defer.inlineCallbacks
+def attach_socket(upstream, burst, encrypt, port, factory, expected):
+    """
+    Attaches a new downstream over loopback TCP, leaving the reactor to run
+    the chunk replay. Returns a Deferred firing with the number of ``send()``
+    system calls and the time until the client received *expected* bytes.
+    """
+
+    sender = yield connectProtocol(
+        TCP4ClientEndpoint(reactor, "127.0.0.1", port), Protocol())
+    receiver = yield factory.receivers.get()
+    receiver.expected = expected
+    socket = sender.transport.socket = CountingSocket(
+        sender.transport.socket)
+
+    downstream = make_downstream()
+    downstream.transport = sender.transport
+    if encrypt:
+        downstream.cipher.enable(os.urandom(16))
+    downstream.compression_threshold = -1
+    if not burst:
+        downstream.begin_burst = downstream.end_burst = lambda: None
+
+    start = time.perf_counter()
+    downstream.begin_burst()
+    for plugin in upstream.plugins:
+        plugin.set_downstream(downstream)
+        plugin.set_forwarding(True)
+        plugin.attach()
+    downstream.end_burst()
+    end = yield receiver.done
+
+    for plugin in upstream.plugins:
+        plugin.remove_downstream(downstream)
+        plugin.detach()
+        plugin.set_forwarding(False)
+        plugin.set_downstream(None)
+    sender.transport.loseConnection()
+    defer.returnValue((socket.sends, end - start))
+
+
+@defer.inlineCallbacks
+def run(reactor, radius, mobs):
+    upstream = make_upstream()
+    populate(upstream, radius, mobs)
+    attach(upstream, False, False)
+
+    factory = ReceiverFactory()
+    listener = yield TCP4ServerEndpoint(
+        reactor, 0, interface="127.0.0.1").listen(factory)
+    port = listener.getHost().port
+
+    for encrypt in (False, True):
+        for burst in (False, True):
+            writes, elapsed, size = attach(upstream, burst, encrypt)
+            sends, received = yield attach_socket(
+                upstream, burst, encrypt, port, factory, size)
+            print("%-10s %-9s %6d writes, %8.1f ms; "
+                  "%6d sends, %8.1f ms to receive %.1f MB" % (
+                      "burst" if burst else "per-packet",
+                      "encrypted" if encrypt else "plain",
+                      writes, elapsed * 1000,
+                      sends, received * 1000, size / 1048576.0))
+    yield listener.stopListening()
+
+
+def main(radius=10, mobs=2000):
+    task.react(run, (radius, mobs))
+
+
+if __name__ == "__main__":
+    main()
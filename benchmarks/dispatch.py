@@ -0,0 +1,56 @@
+"""
+Measures ``Upstream.dispatch_packet`` throughput using the plugin dispatch
+table, and compares it against the previous per-packet ``getattr()`` scan
+over every plugin.
+"""
+
+from benchmarks import make_upstream, measure
+
+
+def legacy_dispatch(upstream, buff, name, direction):
+    buff.save()
+    method_name = "packet_%s_%s" % (direction, name)
+    for plugin in upstream.plugins:
+        handler = getattr(plugin, method_name, None)
+        if handler:
+            try:
+                handler(buff)
+                assert len(buff) == 0, "Packet too long: %s" % method_name
+            except Exception as e:
+                upstream.logger.exception(e)
+            buff.restore()
+
+
+def get_packets(bt):
+    return [
+        ("downstream", "entity_relative_move",
+         bt.pack_varint(100) + bt.pack('hhh?', 1, 0, -1, True)),
+        ("downstream", "entity_head_look",
+         bt.pack_varint(100) + bt.pack('B', 64)),
+        ("downstream", "time_update", bt.pack('qq', 1000, 2000)),
+        ("downstream", "sound_effect",
+         bt.pack_varint(1) + bt.pack_varint(0) +
+         bt.pack('iiiff', 0, 0, 0, 1, 1)),
+        ("downstream", "particle", bt.pack('i?ffffffi', 0, False, *[0] * 7)),
+        ("upstream", "player", bt.pack('?', True)),
+    ]
+
+
+def main(count=100000):
+    upstream = make_upstream()
+    for direction, name, data in get_packets(upstream.buff_type):
+        def new():
+            upstream.dispatch_packet(upstream.buff_type(data), name, direction)
+
+        def old():
+            legacy_dispatch(
+                upstream, upstream.buff_type(data), name, direction)
+
+        before = measure(old, count)
+        after = measure(new, count)
+        print("%-10s %-22s %10.0f -> %10.0f packets/s (%.1fx)" % (
+            direction, name, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures packing and compressing modified chunks for attach, serially and
+across thread pools of increasing size. Packing is mostly NumPy and
+compression is zlib, both of which release the GIL, so throughput should
+scale with the number of cores available.
+"""
+
+import concurrent.futures
+import os
+import time
+
+from benchmarks import make_upstream, make_downstream, get_plugin, \
+    pack_chunk
+
+
+def main(radius=10, threshold=256):
+    upstream = make_upstream()
+    bt = upstream.buff_type
+    for x in range(-radius, radius + 1):
+        for z in range(-radius, radius + 1):
+            upstream.dispatch_packet(
+                bt(pack_chunk(bt, x, z)), "chunk_data", "downstream")
+    world = get_plugin(upstream, "WorldPlugin")
+    for x, z in world.chunks:
+        world.set_block(16 * x, 0, 16 * z, 1)
+
+    ident = make_downstream().get_packet_ident("chunk_data")
+    jobs = [(coords, world.snapshot_chunk(world.chunks[coords]))
+            for coords in world.chunks]
+
+    print("%d chunks, %d cores" % (len(jobs), os.cpu_count()))
+    for workers in (0, 1, 2, 4, 8):
+        start = time.perf_counter()
+        if workers == 0:
+            for coords, snapshot in jobs:
+                world.encode_chunk(coords, snapshot, ident, threshold)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                list(pool.map(
+                    lambda job: world.encode_chunk(
+                        job[0], job[1], ident, threshold),
+                    jobs))
+        elapsed = time.perf_counter() - start
+        print("%-8s %8.1f ms" % (
+            "%d threads" % workers if workers else "serial",
+            elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
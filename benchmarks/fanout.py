@@ -0,0 +1,69 @@
+"""
+Measures the cost of forwarding packets to increasing numbers of attached
+clients. Each packet is encoded and compressed once for the group, so the
+cost of each extra client should be little more than its transport write.
+The extra cost per client is printed alongside the cost of a bare write of
+the same frames, for comparison. Each figure is the best of three runs.
+"""
+
+import os
+
+from benchmarks import make_upstream, make_downstream, measure
+from benchmarks.burst import populate
+
+
+def main(count=20000, threshold=256):
+    upstream = make_upstream()
+    upstream.compression_threshold = threshold
+    populate(upstream, 0, 0)
+    bt = upstream.buff_type
+    data = bt.pack_varint(1) + bt.pack('hhh', 1, 2, 3) + bt.pack('?', True)
+    particle = bt.pack('i?fffffffi', 0, False, 0, 0, 0, 1, 1, 1, 0, 300) + \
+        os.urandom(300)
+
+    clients = []
+    costs = {}
+    for total in (1, 2, 4, 8):
+        while len(clients) < total:
+            downstream = make_downstream()
+            downstream.display_name = "viewer%d" % len(clients)
+            downstream.compression_threshold = threshold
+            upstream.downstream_player_joined(downstream)
+            clients.append(downstream)
+
+        def send():
+            upstream.dispatch_packet(
+                bt(data), "entity_relative_move", "downstream")
+            upstream.dispatch_packet(
+                bt(particle), "particle", "downstream")
+            for downstream in clients:
+                downstream.transport.clear()
+
+        rate = 2 * max(measure(send, count) for _ in range(3))
+        costs[total] = 1e6 / rate
+        print("%d clients: %8.0f packets/sec, %6.2f us per packet" % (
+            total, rate, costs[total]))
+
+    # The same frames written straight to a client's transport
+    downstream = clients[0]
+    frames = [bt.pack_packet(
+        bt.pack_varint(downstream.get_packet_ident(name)) + payload,
+        threshold)
+        for name, payload in (("entity_relative_move", data),
+                              ("particle", particle))]
+
+    def write():
+        for frame in frames:
+            downstream.send_frame(frame)
+        downstream.transport.clear()
+
+    rate = 2 * max(measure(write, count) for _ in range(3))
+    print("extra cost per client: %.2f us per packet, bare write: %.2f us" % (
+        (costs[8] - costs[1]) / 7, 1e6 / rate))
+
+    for downstream in clients:
+        upstream.downstream_player_left(downstream)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Replays a packet trace, recorded by setting ``trace_path``, through a fresh
+session without a server. Records are replayed as fast as possible by
+default, or at a multiple of real time with ``--speed``. A client can be
+attached part way through, so that attach and forwarding costs are included.
+Reports throughput and the packet types that took longest to dispatch::
+
+    $ python -m benchmarks.replay alice-20190101-120000.trace
+    $ python -m benchmarks.replay alice.trace --attach 60 --profile out.prof
+    $ python -m benchmarks.replay alice.trace --speed 1
+"""
+
+import argparse
+import collections
+import cProfile
+import pstats
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+
+from benchmarks import make_upstream, make_downstream, get_plugin
+from packet_trace import TraceReader
+
+
+class Replay(object):
+    def __init__(self, reader, attach_at=None):
+        self.reader = reader
+        self.attach_at = attach_at
+        self.upstream = make_upstream()
+        self.upstream.compression_threshold = reader.compression_threshold
+        if self.upstream.protocol_version != reader.protocol_version:
+            raise SystemExit(
+                "Trace uses protocol %d, but protocol_version is %d" % (
+                    reader.protocol_version, self.upstream.protocol_version))
+        self.downstream = None
+        self.attach_time = None
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self.records = 0
+        self.duration = 0
+
+    def attach(self):
+        # Attaches a client and replays every chunk to it
+        downstream = self.downstream = make_downstream()
+        downstream.display_name = "replay"
+        downstream.compression_threshold = self.reader.compression_threshold
+        start = time.perf_counter()
+        self.upstream.downstream_player_joined(downstream)
+        world = get_plugin(self.upstream, "WorldPlugin")
+        replay = world.replays[downstream]
+        replay.call.cancel()
+        while world.replay_chunks(replay):
+            pass
+        self.attach_time = time.perf_counter() - start
+
+    def replay_record(self, when, kind, name, body):
+        if self.attach_at is not None and self.downstream is None and \
+                when >= self.attach_at:
+            self.attach()
+
+        upstream = self.upstream
+        start = time.perf_counter()
+        if kind == "downstream":
+            upstream.packet_received(upstream.buff_type(body), name)
+        elif kind == "upstream":
+            upstream.dispatch_packet(
+                upstream.buff_type(body), name, "upstream")
+        elif upstream.downstreams.members:
+            upstream.relay_frames(body)
+        key = "%s %s" % (kind, name or "frames")
+        self.times[key] += time.perf_counter() - start
+        self.counts[key] += 1
+
+        self.records += 1
+        self.duration = when
+        if self.records % 1000 == 0:
+            upstream.transport.clear()
+            if self.downstream is not None:
+                self.downstream.transport.clear()
+
+    def run(self):
+        for record in self.reader:
+            self.replay_record(*record)
+
+    @defer.inlineCallbacks
+    def run_timed(self, speed):
+        self.upstream.ticker.start()
+        start = time.monotonic()
+        for when, kind, name, body in self.reader:
+            delay = start + when / speed - time.monotonic()
+            if delay > 0.001:
+                yield task.deferLater(reactor, delay, lambda: None)
+            self.replay_record(when, kind, name, body)
+        self.upstream.ticker.stop()
+
+    def report(self, elapsed, top=15):
+        print("Replayed %d records covering %.1f s in %.2f s (%.0f/s)" % (
+            self.records, self.duration, elapsed, self.records / elapsed))
+        if self.attach_time is not None:
+            print("Attached in %.1f ms" % (1000 * self.attach_time))
+        print("%-45s %10s %10s %10s" % ("record", "count", "ms", "us each"))
+        for key, spent in self.times.most_common(top):
+            print("%-45s %10d %10.1f %10.2f" % (
+                key, self.counts[key], 1000 * spent,
+                1e6 * spent / self.counts[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="trace file to replay")
+    parser.add_argument("--speed", type=float,
+                        help="replay at this multiple of real time")
+    parser.add_argument("--attach", type=float, metavar="SECONDS",
+                        help="attach a client this far into the trace")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="write cProfile stats to this file")
+    args = parser.parse_args()
+
+    reader = TraceReader(args.path)
+    replay = Replay(reader, args.attach)
+    start = time.perf_counter()
+    if args.speed:
+        replay.run_timed(args.speed).addBoth(lambda _: reactor.stop())
+        reactor.run()
+    elif args.profile:
+        profile = cProfile.Profile()
+        profile.runcall(replay.run)
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile, stream=sys.stdout).sort_stats(
+            "cumulative").print_stats(20)
+    else:
+        replay.run()
+    replay.report(time.perf_counter() - start)
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
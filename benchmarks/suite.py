@@ -0,0 +1,292 @@
+"""
+Runs the benchmark suite and writes the results as JSON, so that runs can be
+compared. The suite measures:
+
+* ``dispatch``: ``Upstream.dispatch_packet`` throughput per packet type, in
+  packets per second, both detached and with a client attached.
+* ``handlers``: the cost of each plugin handler, in microseconds per call.
+* ``attach``: wall time and bytes written by each plugin's ``attach()``,
+  including chunk replay, for a session with a view distance of chunks and
+  a crowd of mobs. Measured before and after preparing in the background.
+* ``memory``: bytes held per cached chunk, per decoded chunk and per
+  entity, as traced by ``tracemalloc``.
+
+The suite runs at the ``protocol_version`` in ``config.py``, which is
+recorded in the results. Synthetic packets that the version lacks are
+skipped, so only runs at the same version are comparable.
+
+Usage::
+
+    $ python -m benchmarks.suite -o results.json
+    $ python -m benchmarks.suite -o results.json --compare baseline.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from quarry.data.packets import packet_idents
+from quarry.types.uuid import UUID
+
+from benchmarks import make_upstream, make_downstream, get_plugin, \
+    pack_chunk, measure
+from benchmarks.burst import populate
+
+
+def get_packets(upstream, mobs):
+    """
+    Returns a list of ``(direction, name, pack)`` tuples for packets typical
+    of a busy session, where ``pack()`` returns a payload. Entity packets
+    refer to the mobs spawned by ``populate()``, and block packets to its
+    chunks. Packets that the upstream's protocol version lacks are left out.
+    """
+
+    bt = upstream.buff_type
+
+    def entity_ids():
+        while True:
+            for entity_id in range(1, mobs + 1):
+                yield bt.pack_varint(entity_id)
+
+    ids = entity_ids()
+    typical = [
+        ("downstream", "entity_relative_move",
+         lambda: next(ids) + bt.pack('hhh?', 1, 0, -1, True)),
+        ("downstream", "entity_look_and_relative_move",
+         lambda: next(ids) + bt.pack('hhhBB?', 1, 0, -1, 64, 0, True)),
+        ("downstream", "entity_head_look",
+         lambda: next(ids) + bt.pack('B', 64)),
+        ("downstream", "entity_teleport",
+         lambda: next(ids) + bt.pack('dddBB?', 8.5, 64, 8.5, 0, 0, True)),
+        ("downstream", "entity_velocity",
+         lambda: next(ids) + bt.pack('hhh', 0, -100, 0)),
+        ("downstream", "entity_metadata",
+         lambda: next(ids) + bt.pack_entity_metadata(
+             {(0, 0): 0, (2, 7): 20.0})),
+        ("downstream", "block_change",
+         lambda: bt.pack_position(5, 64, 5) + bt.pack_varint(1)),
+        ("downstream", "multi_block_change",
+         lambda: bt.pack('ii', 0, 0) + bt.pack_varint(8) + b"".join(
+             bt.pack('BB', n * 17, 64) + bt.pack_varint(1)
+             for n in range(8))),
+        ("downstream", "time_update", lambda: bt.pack('qq', 1000, 2000)),
+        ("downstream", "chat_message",
+         lambda: bt.pack_chat("<bob> hello there") + bt.pack('b', 0)),
+        ("downstream", "update_health",
+         lambda: bt.pack('f', 20.0) + bt.pack_varint(20) + bt.pack('f', 5)),
+        ("downstream", "set_slot",
+         lambda: bt.pack('bh', 0, 36) + bt.pack_slot(1, 1)),
+        ("downstream", "sound_effect",
+         lambda: bt.pack_varint(1) + bt.pack_varint(0) +
+         bt.pack('iiiff', 0, 0, 0, 1, 1)),
+        ("downstream", "particle",
+         lambda: bt.pack('i?ffffffi', 0, False, *[0] * 7)),
+        ("upstream", "player_position",
+         lambda: bt.pack('ddd?', 8.5, 64, 8.5, True)),
+        ("upstream", "player_look", lambda: bt.pack('ff?', 0, 0, True)),
+        ("upstream", "player", lambda: bt.pack('?', True)),
+    ]
+    return [(direction, name, pack) for direction, name, pack in typical
+            if (upstream.protocol_version, "play", direction, name)
+            in packet_idents]
+
+
+def make_session(radius, mobs):
+    upstream = make_upstream()
+    upstream.compression_threshold = 256
+    populate(upstream, radius, mobs)
+    return upstream
+
+
+def bench_dispatch(upstream, packets, count):
+    results = {}
+    bt = upstream.buff_type
+    for direction, name, pack in packets:
+        payloads = [pack() for _ in range(64)]
+        cycle = iter(payloads * (count // 64 + 1))
+
+        def dispatch():
+            upstream.dispatch_packet(bt(next(cycle)), name, direction)
+
+        results["%s %s" % (direction, name)] = measure(dispatch, count)
+        upstream.transport.clear()
+        for downstream in upstream.downstreams.members:
+            downstream.transport.clear()
+    return results
+
+
+def bench_handlers(upstream, packets, count):
+    results = {}
+    bt = upstream.buff_type
+    for direction, name, pack in packets:
+        for handler in upstream.handlers.get((direction, name), ()):
+            payloads = [pack() for _ in range(64)]
+            cycle = iter(payloads * (count // 64 + 1))
+
+            def call():
+                handler(bt(next(cycle)))
+
+            results["%s.%s" % (
+                type(handler.__self__).__name__, handler.__name__)] = \
+                1e6 / measure(call, count)
+    return results
+
+
+def bench_attach(upstream):
+    """
+    Attaches a new client, replaying every chunk. Returns the total time in
+    milliseconds and bytes written, and the same for each plugin.
+    """
+
+    downstream = make_downstream()
+    downstream.compression_threshold = 256
+    world = get_plugin(upstream, "WorldPlugin")
+    results = {"plugins": {}}
+
+    start = time.perf_counter()
+    for plugin in upstream.plugins:
+        plugin_start = time.perf_counter()
+        written = len(downstream.transport.value())
+        plugin.set_downstream(downstream)
+        plugin.set_forwarding(True)
+        plugin.attach()
+        if plugin is world:
+            replay = world.replays[downstream]
+            replay.call.cancel()
+            while world.replay_chunks(replay):
+                pass
+        results["plugins"][type(plugin).__name__] = {
+            "ms": 1000 * (time.perf_counter() - plugin_start),
+            "bytes": len(downstream.transport.value()) - written}
+    results["ms"] = 1000 * (time.perf_counter() - start)
+    results["bytes"] = len(downstream.transport.value())
+
+    for plugin in upstream.plugins:
+        plugin.remove_downstream(downstream)
+        plugin.detach()
+        plugin.set_forwarding(False)
+        plugin.set_downstream(None)
+    return results
+
+
+def bench_memory(radius, mobs):
+    upstream = make_session(0, 0)
+    bt = upstream.buff_type
+    world = get_plugin(upstream, "WorldPlugin")
+    count = (2 * radius + 1) ** 2
+
+    # Payloads are packed while tracing, as the world keeps a reference to
+    # them, just as it would to data received from the server
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for x in range(-radius, radius + 1):
+            for z in range(-radius, radius + 1):
+                upstream.dispatch_packet(
+                    bt(pack_chunk(bt, x, z)), "chunk_data", "downstream")
+        after_chunks = tracemalloc.get_traced_memory()[0]
+        for x, z in list(world.chunks):
+            world.set_block(16 * x, 0, 16 * z, 1)
+        after_decode = tracemalloc.get_traced_memory()[0]
+        for entity_id in range(1000, 1000 + mobs):
+            upstream.dispatch_packet(bt(
+                bt.pack_varint(entity_id) +
+                bt.pack_uuid(UUID.random()) +
+                bt.pack_varint(90) +
+                bt.pack('ddd', entity_id % 64, 64, entity_id // 64) +
+                bt.pack('BBBhhh', 0, 0, 0, 0, 0, 0) +
+                bt.pack('B', 0xff)), "spawn_mob", "downstream")
+        after_entities = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "chunk_bytes": (after_chunks - before) / count,
+        "decoded_chunk_bytes": (after_decode - before) / count,
+        "entity_bytes": (after_entities - after_decode) / mobs}
+
+
+def run(radius, mobs, count):
+    results = {"meta": {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "radius": radius,
+        "mobs": mobs,
+        "count": count}}
+
+    upstream = make_session(radius, mobs)
+    results["meta"]["protocol_version"] = upstream.protocol_version
+    packets = get_packets(upstream, mobs)
+
+    results["attach"] = {"cold": bench_attach(upstream)}
+    for plugin in upstream.plugins:
+        while plugin.get_staleness()[0]:
+            plugin.prepare()
+    results["attach"]["prepared"] = bench_attach(upstream)
+
+    results["dispatch"] = {"detached": bench_dispatch(
+        upstream, packets, count)}
+    downstream = make_downstream()
+    downstream.compression_threshold = 256
+    upstream.forwarding = True
+    upstream.downstreams.add(downstream)
+    results["dispatch"]["attached"] = bench_dispatch(
+        upstream, packets, count)
+    upstream.downstreams.remove(downstream)
+    upstream.forwarding = False
+
+    results["handlers"] = bench_handlers(upstream, packets, count)
+    results["memory"] = bench_memory(radius, mobs)
+    return results
+
+
+def flatten(results, prefix=""):
+    # Yields (path, value) pairs for each number in the results
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + "/"):
+                yield item
+        elif key != "time" and isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(baseline, results):
+    versions = (baseline["meta"].get("protocol_version"),
+                results["meta"]["protocol_version"])
+    if versions[0] != versions[1]:
+        print("warning: comparing runs at protocol %s and %s" % versions)
+    baseline = dict(flatten(baseline))
+    for path, value in flatten(results):
+        old = baseline.get(path)
+        if old:
+            print("%-60s %12.4g -> %12.4g (%.2fx)" % (
+                path, old, value, value / old))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="file to write results to")
+    parser.add_argument("--compare", help="results file to compare against")
+    parser.add_argument("--radius", type=int, default=10)
+    parser.add_argument("--mobs", type=int, default=500)
+    parser.add_argument("--count", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = run(args.radius, args.mobs, args.count)
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(json.load(fd), results)
+
+
+if __name__ == "__main__":
+    main()
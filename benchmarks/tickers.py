@@ -0,0 +1,76 @@
+"""
+Compares running the tasks of many idle sessions with a quarry ticker, and
+so a reactor timer, per session against running them from the shared timer
+wheel. Each variant runs under the reactor for a few seconds, and its CPU
+time per tick and transport writes are counted. Each session has spawned,
+so runs its position updates and any other tasks its plugins have added.
+"""
+
+import time
+
+from twisted.internet import reactor, defer, task
+from quarry.net.ticker import Ticker, LoopTask
+
+from benchmarks import make_upstream
+from benchmarks.burst import CountingTransport
+
+
+class QuarryTicker(Ticker):
+    # As sessions' tickers were before the wheel: one timer each, charging
+    # each tick to the session
+    session = None
+
+    def _update(self, count):
+        self.session.charge(super(QuarryTicker, self)._update, count)
+
+
+def spawn(upstream):
+    bt = upstream.buff_type
+    upstream.transport = CountingTransport()
+    upstream.dispatch_packet(bt(
+        bt.pack('dddffB', 8.5, 64, 8.5, 0, 0, 0) + bt.pack_varint(1)),
+        "player_position_and_look", "downstream")
+
+
+def start_quarry(upstreams):
+    tickers = []
+    for upstream in upstreams:
+        ticker = QuarryTicker(upstream.logger)
+        ticker.session = upstream.session
+        for loop in upstream.ticker._tasks:
+            if isinstance(loop, LoopTask):
+                ticker.add_loop(loop.interval, loop.callback)
+        ticker.start()
+        tickers.append(ticker)
+    return tickers
+
+
+def start_wheel(upstreams):
+    for upstream in upstreams:
+        upstream.ticker.start()
+    return [upstream.ticker for upstream in upstreams]
+
+
+@defer.inlineCallbacks
+def main(sessions=500, seconds=5):
+    upstreams = [make_upstream() for _ in range(sessions)]
+    ticks = seconds / Ticker.interval
+    for name, start in (("per-session", start_quarry),
+                        ("wheel", start_wheel)):
+        for upstream in upstreams:
+            spawn(upstream)
+        tickers = start(upstreams)
+        cpu_time = time.process_time()
+        yield task.deferLater(reactor, seconds, lambda: None)
+        cpu_time = time.process_time() - cpu_time
+        for ticker in tickers:
+            ticker.stop()
+        writes = sum(upstream.transport.writes for upstream in upstreams)
+        print("%-12s %d sessions: %7d writes, %8.1f us/tick" % (
+            name, sessions, writes, 1e6 * cpu_time / ticks))
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
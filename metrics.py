@@ -0,0 +1,161 @@
+"""
+Counters for plugin handler timings, packet traffic and ticker timing,
+readable through ``/minebnc stats`` and a local Prometheus endpoint.
+
+Counting is enabled per session by wrapping its handlers and dispatch when
+plugins are loaded, so sessions without metrics pay nothing.
+"""
+
+import collections
+from time import perf_counter
+
+from twisted.web.resource import Resource
+
+
+class Metrics(object):
+    def __init__(self):
+        # Handlers map (plugin, handler) to [calls, seconds, max seconds].
+        # Traffic maps (direction, packet) to [packets, bytes].
+        self.handlers = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self.traffic = collections.defaultdict(lambda: [0, 0])
+
+    def reset(self):
+        # Handler counters are held by their timing wrappers
+        for counter in self.handlers.values():
+            counter[:] = [0, 0.0, 0.0]
+        self.traffic.clear()
+
+    def wrap_handlers(self, handlers):
+        # Returns a copy of a dispatch table with each handler timed
+        return {key: [self.time_handler(handler) for handler in value]
+                for key, value in handlers.items()}
+
+    def time_handler(self, handler):
+        counter = self.handlers[
+            type(handler.__self__).__name__, handler.__name__]
+
+        def timed(buff):
+            start = perf_counter()
+            try:
+                return handler(buff)
+            finally:
+                elapsed = perf_counter() - start
+                counter[0] += 1
+                counter[1] += elapsed
+                if elapsed > counter[2]:
+                    counter[2] = elapsed
+
+        timed.__name__ = handler.__name__
+        return timed
+
+    def count(self, direction, name, size):
+        counter = self.traffic[direction, name]
+        counter[0] += 1
+        counter[1] += size
+
+    def describe(self, count=5):
+        # Returns lines for the costliest handlers and busiest packets
+        lines = [u"\u00a7ahandlers by time:"]
+        handlers = sorted(self.handlers.items(), key=lambda item: -item[1][1])
+        for (plugin, handler), (calls, total, longest) in handlers[:count]:
+            lines.append("%s.%s: %d calls, %.1f ms, max %.2f ms" % (
+                plugin, handler[7:], calls, 1000 * total, 1000 * longest))
+        lines.append(u"\u00a7apackets by bytes:")
+        traffic = sorted(self.traffic.items(), key=lambda item: -item[1][1])
+        for (direction, name), (packets, size) in traffic[:count]:
+            lines.append("%s %s: %d packets, %.1f KB" % (
+                direction, name, packets, size / 1024.0))
+        return lines
+
+
+def render(sessions, wheel):
+    """
+    Returns the metrics of every session, and of the timer wheel driving
+    their tickers, in the Prometheus text format.
+    """
+
+    families = [
+        ("minebnc_session_cpu_seconds_total", "counter",
+         "CPU time spent on the session"),
+        ("minebnc_session_received_bytes_total", "counter",
+         "Bytes received from the server"),
+        ("minebnc_session_attached_clients", "gauge",
+         "Clients attached to the session"),
+        ("minebnc_session_idle_sent_packets_total", "counter",
+         "Packets sent to the server while no clients were attached"),
+        ("minebnc_handler_calls_total", "counter",
+         "Calls to each plugin packet handler"),
+        ("minebnc_handler_seconds_total", "counter",
+         "Time spent in each plugin packet handler"),
+        ("minebnc_handler_max_seconds", "gauge",
+         "Longest single call to each plugin packet handler"),
+        ("minebnc_packets_total", "counter",
+         "Packets dispatched or relayed, by direction and packet"),
+        ("minebnc_packet_bytes_total", "counter",
+         "Payload bytes dispatched and frame bytes relayed, by packet"),
+        ("minebnc_ticks_total", "counter",
+         "Ticks run by the timer wheel"),
+        ("minebnc_tick_overruns_total", "counter",
+         "Reactor callbacks that fell one or more ticks behind"),
+        ("minebnc_skipped_ticks_total", "counter",
+         "Ticks skipped after falling too far behind"),
+        ("minebnc_tick_busy_seconds_total", "counter",
+         "Time spent running ticks"),
+        ("minebnc_tick_max_busy_seconds", "gauge",
+         "Longest time spent in one reactor callback"),
+        ("minebnc_tick_drift_seconds", "gauge",
+         "How late the last reactor callback ran"),
+        ("minebnc_tick_max_drift_seconds", "gauge",
+         "Latest any reactor callback has run")]
+    samples = collections.defaultdict(list)
+    stats = wheel.get_stats()
+    for family, key in zip(families[9:], (
+            "ticks", "overruns", "skipped", "busy", "max_busy", "drift",
+            "max_drift")):
+        samples[family[0]].append(("", stats[key]))
+
+    for session in sessions:
+        label = 'session="%s"' % session.name
+        samples["minebnc_session_cpu_seconds_total"].append(
+            (label, session.cpu_time))
+        samples["minebnc_session_received_bytes_total"].append(
+            (label, session.received))
+        samples["minebnc_session_attached_clients"].append(
+            (label, len(session.downstreams.members)))
+        samples["minebnc_session_idle_sent_packets_total"].append(
+            (label, session.idle_sent))
+        if session.metrics is None:
+            continue
+        for (plugin, handler), values in session.metrics.handlers.items():
+            labels = '%s,plugin="%s",handler="%s"' % (label, plugin, handler)
+            for family, value in zip(families[4:7], values):
+                samples[family[0]].append((labels, value))
+        for (direction, name), values in session.metrics.traffic.items():
+            labels = '%s,direction="%s",packet="%s"' % (
+                label, direction, name)
+            for family, value in zip(families[7:9], values):
+                samples[family[0]].append((labels, value))
+
+    lines = []
+    for name, kind, description in families:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples[name]:
+            if labels:
+                lines.append("%s{%s} %r" % (name, labels, value))
+            else:
+                lines.append("%s %r" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, sessions, wheel):
+        Resource.__init__(self)
+        self.sessions = sessions
+        self.wheel = wheel
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return render(self.sessions, self.wheel).encode('utf8')
@@ -1,54 +1,391 @@
 import collections
+import ipaddress
+import json
+import logging
+import os
 import os.path
+import resource
+import signal
+import sys
+import time
+import zlib
 
-from twisted.internet import reactor, defer
-from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet import reactor, defer, task
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.protocol import Factory, ProcessProtocol, \
+    ReconnectingClientFactory
+from twisted.protocols import portforward
+from twisted.web.server import Site
 
-from quarry.net.auth import Profile, OfflineProfile
+from quarry.data import packets
+from quarry.net.auth import Profile
 from quarry.net.client import ClientFactory, ClientProtocol
+from quarry.net.protocol import ProtocolError
 from quarry.net.server import ServerFactory, ServerProtocol
+from quarry.types.buffer import Buffer, BufferUnderrun
+
+import config
+
+# Settings added since the first config.py.example. An older config.py gets
+# these defaults, so it keeps working after an upgrade.
+config_defaults = {
+    "loopback_compression": False,
+    "max_clients": 4,
+    "workers": 0,
+    "accounts": [],
+    "chat_log_path": None,
+    "chunk_cache_limit": 256,
+    "chunk_cache_path": None,
+    "chunk_retention_radius": 16,
+    "chunk_encode_threads": 4,
+    "idle_update_interval": 20,
+    "metrics_enabled": False,
+    "metrics_port": None,
+    "trace_path": None,
+    "restart_snapshot_path": "minebnc.snapshot",
+}
+for name, value in config_defaults.items():
+    if not hasattr(config, name):
+        setattr(config, name, value)
 
 from config import *
-from plugins import plugins
+from metrics import Metrics, MetricsResource
+from packet_trace import TraceWriter
+from plugins import plugins, get_handlers
+from snapshot import ResumableCipher, save_snapshot, load_snapshot
+from timer_wheel import WheelTicker, wheel
+
+
+# Sessions --------------------------------------------------------------------
+
+class SessionTicker(WheelTicker):
+    # Charges the time spent running tasks to the protocol's session
+    session = None
+
+    def run(self, tasks):
+        if self.session is None:
+            return super(SessionTicker, self).run(tasks)
+        self.session.charge(super(SessionTicker, self).run, tasks)
+
+
+class Session(object):
+    # A bounced account: its connection to the server, its plugins, and the
+    # clients attached to it. Sessions survive reconnects.
+
+    registry = None
+
+    def __init__(self, profile, host, port):
+        self.profile = profile
+        self.host = host
+        self.port = port
+        self.upstream = None
+        self.downstreams = DownstreamGroup()
+        self.factory = UpstreamFactory(self)
+        self.cpu_time = 0.0
+        self.received = 0
+        self.idle_sent = 0
+        self.metrics = Metrics() if metrics_enabled else None
+
+    @property
+    def name(self):
+        return self.profile.display_name
+
+    def connect(self):
+        self.factory.connect(self.host, self.port)
+
+    def get_snapshot(self):
+        # Returns the state to carry over a hot restart, or None if the
+        # session is not in game
+        upstream = self.upstream
+        if upstream is None or not upstream.in_game:
+            return None
+        state = upstream.get_snapshot()
+        state["cpu_time"] = self.cpu_time
+        state["received"] = self.received
+        state["idle_sent"] = self.idle_sent
+        return state
+
+    def resume(self, state):
+        self.cpu_time = state["cpu_time"]
+        self.received = state["received"]
+        self.idle_sent = state.get("idle_sent", 0)
+        self.factory.snapshot = state
+        reactor.adoptStreamConnection(
+            state["fd"], state["family"], self.factory)
+        os.close(state["fd"])
+
+    def charge(self, fn, *args):
+        # Calls fn, adding the CPU time it takes to this session
+        start = time.thread_time()
+        try:
+            return fn(*args)
+        finally:
+            self.cpu_time += time.thread_time() - start
+
+    def get_memory(self):
+        # Returns a rough estimate of this session's memory use, in bytes
+        if self.upstream is None:
+            return 0
+        return len(self.upstream.recv_buff.buff) + sum(
+            plugin.get_memory() for plugin in self.upstream.plugins)
+
+    def get_stats(self):
+        return {
+            "name": self.name,
+            "connected": self.upstream is not None,
+            "attached": len(self.downstreams.members),
+            "cpu_time": self.cpu_time,
+            "received": self.received,
+            "idle_sent": self.idle_sent}
+
+    def describe(self):
+        if self.upstream is None:
+            state = "disconnected"
+        else:
+            state = "%d attached" % len(self.downstreams.members)
+        return "%s: %s, cpu: %.1f s, memory: %.1f MB, idle sent: %d" % (
+            self.name, state, self.cpu_time, self.get_memory() / 1048576.0,
+            self.idle_sent)
+
+
+class SessionRegistry(object):
+    default = None
+    restart = None
+
+    def __init__(self):
+        self.sessions = collections.OrderedDict()
+
+    def __iter__(self):
+        return iter(self.sessions.values())
 
+    def __len__(self):
+        return len(self.sessions)
 
-# Globals ---------------------------------------------------------------------
+    def add(self, session):
+        self.sessions[session.name.lower()] = session
+        session.registry = self
 
-downstream = None
-upstream = None
+    def route(self, name):
+        return self.sessions.get(name.lower(), self.default)
+
+
+sessions = SessionRegistry()
+
+
+# Connections -----------------------------------------------------------------
+
+class BurstProtocol(object):
+    # Frames sent during a burst are collected, then encrypted and written
+    # in bulk, rather than once per packet.
+
+    burst = None
+    burst_limit = 262144
+
+    def send_packet(self, name, *data):
+        if self.burst is None:
+            return super(BurstProtocol, self).send_packet(name, *data)
+
+        if not self.closed:
+            self.log_packet("# send", name)
+            data = self.buff_type.pack_varint(self.get_packet_ident(name)) + \
+                b"".join(data)
+            self.send_frame(
+                self.buff_type.pack_packet(data, self.compression_threshold))
+
+    def send_frame(self, data):
+        """Sends pre-framed packet data to the remote."""
+
+        if self.burst is None:
+            if not self.closed:
+                self.transport.write(self.cipher.encrypt(data))
+        else:
+            self.burst.append(data)
+            self.burst_size += len(data)
+            if self.burst_size >= self.burst_limit:
+                self.flush_burst()
+
+    def begin_burst(self):
+        if self.burst is None:
+            self.burst = []
+            self.burst_size = 0
+
+    def end_burst(self):
+        if self.burst is not None:
+            self.flush_burst()
+            self.burst = None
+
+    def flush_burst(self):
+        if self.burst and not self.closed:
+            self.transport.write(self.cipher.encrypt(b"".join(self.burst)))
+        self.burst = []
+        self.burst_size = 0
 
 
 # Server ----------------------------------------------------------------------
 
-class Downstream(ServerProtocol):
+class Downstream(BurstProtocol, ServerProtocol):
+    session = None
+    relay_buff = None
+
     def setup(self):
-        global downstream
-        downstream = self
+        self.ticker.protocol = self
 
     def connection_made(self):
-        if not upstream:
-            self.close()
-        else:
-            super(Downstream, self).connection_made()
+        if self.factory.relayed:
+            self.relay_buff = b""
+        super(Downstream, self).connection_made()
+
+    def dataReceived(self, data):
+        if self.relay_buff is not None:
+            data = self.read_relay_header(data)
+            if not data:
+                return
+        if self.session is None:
+            return super(Downstream, self).dataReceived(data)
+        self.session.charge(super(Downstream, self).dataReceived, data)
+
+    def read_relay_header(self, data):
+        # Connections relayed by the supervisor begin with a line holding the
+        # client's address. Returns the data following it.
+        self.relay_buff += data
+        if b"\n" not in self.relay_buff:
+            return b""
+        header, data = self.relay_buff.split(b"\n", 1)
+        self.relay_buff = None
+        host, port = header.decode('ascii').rsplit(" ", 1)
+        address_type = IPv6Address if ":" in host else IPv4Address
+        self.remote_addr = address_type("TCP", host, int(port))
+        return data
 
     def packet_received(self, buff, name):
-        if upstream:
+        # Only the controlling client's packets reach the server
+        session = self.session
+        if session and session.upstream and \
+                self is session.downstreams.controller:
+            upstream = session.upstream
+            if upstream.trace is not None:
+                upstream.trace.write_packet("upstream", name, buff)
             upstream.dispatch_packet(buff, name, "upstream")
         super(Downstream, self).packet_received(buff, name)
 
+    def switch_protocol_mode(self, mode):
+        # Compression is set up per client here rather than by quarry, which
+        # uses a threshold shared by the factory and treats 0 as disabled
+        if mode == "play":
+            self.check_protocol_mode_switch(mode)
+            threshold = self.get_compression_threshold()
+            if threshold >= 0:
+                self.send_packet(
+                    "login_set_compression",
+                    self.buff_type.pack_varint(threshold))
+                self.set_compression(threshold)
+        super(Downstream, self).switch_protocol_mode(mode)
+
+    def get_compression_threshold(self):
+        """
+        Returns the compression threshold to use with this client. This
+        matches the upstream threshold, so compressed frames can be relayed
+        without recompressing them. Compression is disabled for clients on
+        this machine unless ``loopback_compression`` is set.
+        """
+
+        host = ipaddress.ip_address(self.remote_addr.host)
+        if host.is_loopback and not loopback_compression:
+            return -1
+        return self.session.upstream.compression_threshold
+
     def player_joined(self):
+        # Clients are routed to a session by their login name
+        session = sessions.route(self.display_name)
+        if session is None or session.upstream is None:
+            self.close("No session for %s" % self.display_name)
+            return
+        if len(session.downstreams.members) >= max_clients:
+            self.close("Too many clients attached")
+            return
+        if restarting is not None:
+            self.close("MineBNC is restarting")
+            return
+        self.session = session
+        self.ticker.session = session
         super(Downstream, self).player_joined()
-        if upstream:
-            upstream.downstream_player_joined()
+        session.upstream.downstream_player_joined(self)
 
     def player_left(self):
-        if upstream:
-            upstream.downstream_player_left()
+        session = self.session
+        if session and session.upstream and \
+                self in session.downstreams.members:
+            session.upstream.downstream_player_left(self)
+
+
+class DownstreamGroup(object):
+    # The attached clients. The first to attach controls the player, and the
+    # rest are viewers. Packets sent to the group are encoded and compressed
+    # once per compression threshold in use, then written to each client.
+
+    def __init__(self):
+        self.members = []
+        self.compression_threshold = None
+
+    @property
+    def controller(self):
+        if self.members:
+            return self.members[0]
+
+    def add(self, downstream):
+        self.members.append(downstream)
+        self.update_compression_threshold()
+
+    def remove(self, downstream):
+        if downstream in self.members:
+            self.members.remove(downstream)
+            self.update_compression_threshold()
+
+    def update_compression_threshold(self):
+        # Sets the threshold shared by all clients, or None. This is checked
+        # for every relayed frame, so it's worked out only as clients come
+        # and go; clients have finished logging in by the time they're added
+        thresholds = set(member.compression_threshold
+                         for member in self.members)
+        if len(thresholds) == 1:
+            self.compression_threshold = thresholds.pop()
+        else:
+            self.compression_threshold = None
+
+    def get_packet_ident(self, name):
+        return self.members[0].get_packet_ident(name)
+
+    def send_packet(self, name, *data):
+        data = b"".join(data)
+        frames = {}
+        for member in self.members:
+            threshold = member.compression_threshold
+            frame = frames.get(threshold)
+            if frame is None:
+                bt = member.buff_type
+                frame = frames[threshold] = bt.pack_packet(
+                    bt.pack_varint(member.get_packet_ident(name)) + data,
+                    threshold)
+            member.send_frame(frame)
+
+    def send_frame(self, data):
+        for member in self.members:
+            member.send_frame(data)
+
+    def begin_burst(self):
+        for member in self.members:
+            member.begin_burst()
+
+    def end_burst(self):
+        for member in self.members:
+            member.end_burst()
 
 
 class DownstreamFactory(ServerFactory):
     protocol = Downstream
-    max_players = 1
+    ticker_type = SessionTicker
+    relayed = False
+    compression_threshold = None
 
     motd = "MineBNC"
     force_protocol_version = protocol_version
@@ -57,95 +394,803 @@ class DownstreamFactory(ServerFactory):
 
 # Client ----------------------------------------------------------------------
 
-class Upstream(ClientProtocol):
+class Upstream(BurstProtocol, ClientProtocol):
     forwarding = False
+    relay_idents = frozenset()
+    trace = None
+    resumed = False
 
     # Callbacks ---------------------------------------------------------------
 
     def setup(self):
+        self.session = self.factory.session
+        self.downstreams = self.session.downstreams
+        self.ticker.session = self.session
+        self.ticker.protocol = self
+        self.cipher = ResumableCipher()
         self.plugins = []
+        self.handlers = {}
 
     def connection_made(self):
-        global upstream
-        upstream = self
+        self.session.upstream = self
 
+        state, self.factory.snapshot = self.factory.snapshot, None
+        if state is not None:
+            return self.resume(state)
         super(Upstream, self).connection_made()
+        self.load_plugins()
+
+    def connection_lost(self, reason=None):
+        self.closed = True
+        self.session.upstream = None
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+        for downstream in list(self.downstreams.members):
+            self.downstream_player_left(downstream)
+            downstream.close("Lost connection to the server")
+        for plugin in self.plugins:
+            plugin.close()
+
+        # Connections carried over a restart have no connector to retry
+        if self.resumed:
+            reactor.callLater(self.factory.delay, self.session.connect)
+        super(Upstream, self).connection_lost(reason)
+
+    def dataReceived(self, data):
+        self.session.received += len(data)
+        self.session.charge(super(Upstream, self).dataReceived, data)
+
+    def send_packet(self, name, *data):
+        # Packets sent while detached are counted
+        if not self.forwarding:
+            self.session.idle_sent += 1
+        super(Upstream, self).send_packet(name, *data)
+
+    def player_joined(self):
+        super(Upstream, self).player_joined()
+        self.open_trace()
+
+    def open_trace(self):
+        if trace_path:
+            # Traces start in "play" mode, so can be replayed from scratch
+            self.trace = TraceWriter(
+                trace_path.format(
+                    name=self.session.name,
+                    time=time.strftime("%Y%m%d-%H%M%S")),
+                self.protocol_version,
+                self.compression_threshold)
+
+    # Hot restart -------------------------------------------------------------
+
+    # The connection is handed over in "play" mode, once reading has stopped
+    # and everything sent has been written. Any partial packet is carried
+    # over already decrypted.
 
+    def get_snapshot(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+        fd = self.transport.fileno()
+        os.set_inheritable(fd, True)
+        recv_buff = self.recv_buff
+        return {
+            "fd": fd,
+            "family": self.transport.socket.family,
+            "protocol_version": self.protocol_version,
+            "compression_threshold": self.compression_threshold,
+            "cipher": self.cipher.get_state(),
+            "pending": bytes(recv_buff.buff[recv_buff.pos:]),
+            "plugins": {type(plugin).__name__: plugin.get_state()
+                        for plugin in self.plugins}}
+
+    def resume(self, state):
+        self.resumed = True
+        self.protocol_version = state["protocol_version"]
+        self.buff_type = self.factory.get_buff_type(self.protocol_version)
+        self.recv_buff = self.buff_type()
+        self.protocol_mode = "play"
+        self.in_game = True
+        self.compression_threshold = state["compression_threshold"]
+        if state["cipher"] is not None:
+            self.cipher.resume(*state["cipher"])
+
+        self.load_plugins()
+        for plugin in self.plugins:
+            plugin_state = state["plugins"].get(type(plugin).__name__)
+            if plugin_state is not None:
+                plugin.set_state(plugin_state)
+        self.open_trace()
+        self.logger.info("Resumed the game.")
+
+        self.recv_buff.add(state["pending"])
+        self.data_received(b"")
+
+    # Plugins -----------------------------------------------------------------
+
+    def load_plugins(self):
         for plugin in plugins:
             self.plugins.append(plugin(self.buff_type, self.ticker, self))
+        self.handlers = get_handlers(self.plugins)
+        self.ticker.add_loop(1, self.prepare_attach)
 
-    def connection_lost(self, reason=None):
-        global upstream
-        upstream = None
+        # Counting is switched on by replacing methods of this instance, so
+        # the hot path is untouched when metrics are disabled
+        if self.session.metrics is not None:
+            self.handlers = self.session.metrics.wrap_handlers(self.handlers)
+            self.dispatch_packet = self.count_dispatch
+            self.peek_relay = self.count_relay
 
-        super(Upstream, self).connection_lost(reason)
+    def prepare_attach(self):
+        # Runs while detached, so that attach has little left to encode
+        for plugin in self.plugins:
+            try:
+                plugin.prepare()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def log_staleness(self):
+        count, oldest = 0, None
+        for plugin in self.plugins:
+            plugin_count, changed = plugin.get_staleness()
+            count += plugin_count
+            if changed is not None and (oldest is None or changed < oldest):
+                oldest = changed
+        if oldest is None:
+            self.logger.info("Attach snapshot is up to date")
+        else:
+            self.logger.info(
+                "Attach snapshot has %d stale items, oldest changed "
+                "%.1f s ago", count, time.monotonic() - oldest)
+
+    def get_relay_idents(self):
+        """
+        Returns the idents of downstream-bound packets that nothing in the
+        proxy inspects, and so can be relayed as their original frames.
+        """
+
+        idents = set()
+        for key, name in packets.packet_names.items():
+            if key[:3] == (self.protocol_version, "play", self.recv_direction):
+                if (("downstream", name) not in self.handlers and
+                        not hasattr(self, "packet_%s" % name)):
+                    idents.add(key[3])
+        return frozenset(idents)
 
     # Synchronization logic ---------------------------------------------------
 
-    def downstream_player_joined(self):
-        self.logger.info("Attaching...")
-        self.ticker.stop()
-        self.forwarding = True
-        for plugin in self.plugins:
-            plugin.set_downstream(downstream)
-            plugin.set_forwarding(True)
-            plugin.attach()
+    # Plugins attach to each client in turn, with their downstream set to
+    # that client. Otherwise their downstream is the group of all clients.
+
+    def downstream_player_joined(self, downstream):
+        downstreams = self.downstreams
+        self.logger.info("Attaching %s...", downstream.display_name)
+        if not downstreams.members:
+            self.ticker.stop()
+            self.relay_idents = self.get_relay_idents()
+            self.log_staleness()
+            self.forwarding = True
+        downstreams.add(downstream)
+        downstream.begin_burst()
+        try:
+            for plugin in self.plugins:
+                plugin.set_downstream(downstream)
+                plugin.set_forwarding(True)
+                plugin.attach()
+                plugin.set_downstream(downstreams)
+        finally:
+            downstream.end_burst()
         self.logger.info("Attached!")
 
-    def downstream_player_left(self):
-        self.logger.info("Detaching...")
+    def downstream_player_left(self, downstream):
+        downstreams = self.downstreams
+        self.logger.info("Detaching %s...", downstream.display_name)
+        downstreams.remove(downstream)
         for plugin in self.plugins:
-            plugin.detach()
-            plugin.set_forwarding(False)
-            plugin.set_downstream(None)
-        self.forwarding = False
-        self.ticker.start()
+            plugin.remove_downstream(downstream)
+        if not downstreams.members:
+            for plugin in self.plugins:
+                plugin.detach()
+                plugin.set_forwarding(False)
+                plugin.set_downstream(None)
+            self.forwarding = False
+            self.ticker.start()
         self.logger.info("Detached!")
 
 
     # Packet handlers ---------------------------------------------------------
 
+    def data_received(self, data):
+        if not self.forwarding:
+            return super(Upstream, self).data_received(data)
+
+        # Decrypt data
+        data = self.cipher.decrypt(data)
+
+        # Add it to our buffer
+        recv_buff = self.recv_buff
+        recv_buff.add(data)
+
+        # Read some packets. Runs of packets that can be relayed are sent
+        # downstream as a single slice of their original frames.
+        relay_start = recv_buff.pos
+        while not self.closed:
+            frame_start = recv_buff.pos
+            try:
+                if self.peek_relay(recv_buff):
+                    continue
+            except BufferUnderrun:
+                recv_buff.pos = frame_start
+                break
+
+            # Flush frames waiting to be relayed
+            self.relay_frames(recv_buff.buff[relay_start:frame_start])
+
+            # Read the packet
+            recv_buff.pos = frame_start
+            buff = recv_buff.unpack_packet(
+                self.buff_type,
+                self.compression_threshold)
+
+            try:
+                # Identify the packet
+                name = self.get_packet_name(buff.unpack_varint())
+
+                # Dispatch the packet
+                try:
+                    self.packet_received(buff, name)
+                except BufferUnderrun:
+                    raise ProtocolError("Packet is too short: %s" % name)
+                if len(buff) > 0:
+                    raise ProtocolError("Packet is too long: %s" % name)
+
+                # Reset the inactivity timer
+                self.connection_timer.restart()
+
+            except ProtocolError as e:
+                self.protocol_error(e)
+
+            relay_start = recv_buff.pos
+
+        # Flush frames waiting to be relayed, and keep any incomplete frame
+        self.relay_frames(recv_buff.buff[relay_start:recv_buff.pos])
+        recv_buff.save()
+
+    def peek_relay(self, recv_buff):
+        """
+        Reads a frame from the receive buffer and returns ``True`` if it can
+        be relayed downstream as-is. Otherwise, the buffer position is left
+        somewhere within the frame and ``False`` is returned. Raises
+        ``BufferUnderrun`` if the buffer does not contain a complete frame.
+        """
+
+        length = recv_buff.unpack_varint(max_bits=32)
+        if len(recv_buff) < length:
+            raise BufferUnderrun()
+        frame_end = recv_buff.pos + length
+
+        threshold = self.compression_threshold
+        if self.downstreams.compression_threshold != threshold:
+            return False
+
+        if threshold >= 0 and recv_buff.unpack_varint() > 0:
+            # Inflate just enough of a compressed packet to read its ident
+            data = memoryview(recv_buff.buff)[recv_buff.pos:frame_end]
+            ident = self.buff_type(zlib.decompressobj().decompress(
+                data, 5)).unpack_varint()
+        else:
+            ident = recv_buff.unpack_varint()
+
+        if ident not in self.relay_idents:
+            return False
+
+        recv_buff.pos = frame_end
+        return True
+
+    def relay_frames(self, data):
+        if data:
+            if self.trace is not None:
+                self.trace.write_frames(data)
+            self.downstreams.send_frame(data)
+            self.connection_timer.restart()
+
     def packet_received(self, buff, name):
+        if self.trace is not None:
+            self.trace.write_packet("downstream", name, buff)
         self.dispatch_packet(buff, name, "downstream")
         super(Upstream, self).packet_received(buff, name)
 
 
+    def count_dispatch(self, buff, name, direction):
+        self.session.metrics.count(direction, name, len(buff))
+        Upstream.dispatch_packet(self, buff, name, direction)
+
+    def count_relay(self, recv_buff):
+        start = recv_buff.pos
+        if Upstream.peek_relay(self, recv_buff):
+            self.session.metrics.count(
+                "downstream", "relayed", recv_buff.pos - start)
+            return True
+        return False
+
     def dispatch_packet(self, buff, name, direction):
-        buff.save()
-        method_name = "packet_%s_%s" % (direction, name)
-        for plugin in self.plugins:
-            handler = getattr(plugin, method_name, None)
-            if handler:
+        # Handlers may return True to stop the packet being forwarded
+        forward = self.forwarding
+        handlers = self.handlers.get((direction, name))
+        if handlers:
+            buff.save()
+            for handler in handlers:
                 try:
-                    handler(buff)
-                    assert len(buff) == 0, "Packet too long: %s" % method_name
+                    if handler(buff):
+                        forward = False
+                    assert len(buff) == 0, "Packet too long: %s" % (
+                        handler.__name__)
                 except Exception as e:
                     self.logger.exception(e)
                 buff.restore()
 
-        if self.forwarding:
+        if forward:
             if direction == "upstream":
-                endpoint = upstream
+                endpoint = self
             else:
-                endpoint = downstream
+                endpoint = self.downstreams
             endpoint.send_packet(name, buff.read())
 
 
 class UpstreamFactory(ClientFactory, ReconnectingClientFactory):
     protocol = Upstream
+    ticker_type = SessionTicker
     force_protocol_version = protocol_version
     log_level = log_level
 
+    snapshot = None
+
+    def __init__(self, session):
+        super(UpstreamFactory, self).__init__(session.profile)
+        self.session = session
+
+
+# Workers ---------------------------------------------------------------------
+
+# With 'workers' set, a supervisor process spreads the accounts over that
+# many worker processes. The supervisor accepts client connections, reads
+# the login name, and relays the connection to the worker that owns the
+# account. Workers report their sessions' stats to the supervisor as JSON
+# lines on file descriptor 3.
+
+class RelayClient(portforward.ProxyClient):
+    def connectionMade(self):
+        self.transport.write(self.peer.get_preamble())
+        portforward.ProxyClient.connectionMade(self)
+
+
+class RelayClientFactory(portforward.ProxyClientFactory):
+    protocol = RelayClient
+
+
+class Router(portforward.ProxyServer):
+    clientProtocolFactory = RelayClientFactory
+    noisy = False
+
+    def connectionMade(self):
+        self.received = b""
+        self.routed = False
+
+    def dataReceived(self, data):
+        if self.peer is not None:
+            return self.peer.transport.write(data)
+        self.received += data
+        if self.routed:
+            return
+        try:
+            name = self.read_login_name()
+        except BufferUnderrun:
+            return
+        except Exception:
+            return self.transport.loseConnection()
+
+        worker = self.factory.supervisor.route(name)
+        if worker is None or worker.port is None:
+            return self.transport.loseConnection()
+        self.routed = True
+        self.transport.pauseProducing()
+        client = self.clientProtocolFactory()
+        client.setServer(self)
+        reactor.connectTCP("127.0.0.1", worker.port, client)
+
+    def read_login_name(self):
+        # Returns the name from 'Login Start', or None for a status request
+        buff = Buffer(self.received)
+        handshake = buff.unpack_packet(Buffer)
+        handshake.unpack_varint()
+        handshake.unpack_varint()
+        handshake.unpack_string()
+        handshake.unpack('H')
+        if handshake.unpack_varint() != 2:
+            return None
+        login_start = buff.unpack_packet(Buffer)
+        login_start.unpack_varint()
+        return login_start.unpack_string()
+
+    def get_preamble(self):
+        address = self.transport.getPeer()
+        preamble = b"%s %d\n%s" % (
+            address.host.encode('ascii'), address.port, self.received)
+        self.received = b""
+        return preamble
+
+
+class RouterFactory(Factory):
+    protocol = Router
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+
+class Worker(ProcessProtocol):
+    report_interval = 10
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.port = None
+        self.stats = None
+        self.updated = None
+        self.buff = b""
+
+    def childDataReceived(self, fd, data):
+        self.buff += data
+        while b"\n" in self.buff:
+            line, self.buff = self.buff.split(b"\n", 1)
+            report = json.loads(line)
+            if "port" in report:
+                self.port = report["port"]
+                self.supervisor.logger.info(
+                    "Worker %d listening on port %d", self.index, self.port)
+            else:
+                self.stats = report
+                self.updated = time.monotonic()
+
+    def processEnded(self, reason):
+        self.port = None
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(object):
+    restart_delay = 5
+    report_interval = 60
+
+    def __init__(self, accounts, count):
+        self.logger = logging.getLogger("Supervisor")
+        self.logger.setLevel(log_level)
+        count = min(count, len(accounts))
+        self.owners = {}
+        for idx, (name, host, port) in enumerate(accounts):
+            self.owners[name.lower()] = idx % count
+        self.workers = [None] * count
+        self.totals = None
+        self.stopping = False
+
+    def start(self):
+        for idx in range(len(self.workers)):
+            self.spawn(idx)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        reactor.listenTCP(
+            listen_port, RouterFactory(self), interface=listen_host)
+        task.LoopingCall(self.log_stats).start(
+            self.report_interval, now=False)
+
+    def spawn(self, idx):
+        worker = self.workers[idx] = Worker(self, idx)
+        reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, os.path.abspath(__file__),
+             "--worker", str(idx), str(len(self.workers))],
+            env=os.environ,
+            childFDs={0: "w", 1: 1, 2: 2, 3: "r"})
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if worker.transport.pid is not None:
+                worker.transport.signalProcess("TERM")
+
+    def worker_ended(self, worker, reason):
+        if self.stopping:
+            return
+        self.logger.error(
+            "Worker %d exited (%s), restarting in %d s", worker.index,
+            reason.getErrorMessage(), self.restart_delay)
+        reactor.callLater(self.restart_delay, self.spawn, worker.index)
+
+    def route(self, name):
+        # Status requests go to the first worker, as do unknown names,
+        # which it will refuse
+        if len(self.owners) == 1:
+            idx = 0
+        else:
+            idx = self.owners.get((name or "").lower(), 0)
+        return self.workers[idx]
+
+    def log_stats(self):
+        now = time.monotonic()
+        sessions = []
+        cpu_time = memory = overruns = drift = 0
+        for worker in self.workers:
+            if worker.stats is None:
+                continue
+            if now - worker.updated > 3 * worker.report_interval:
+                self.logger.warning(
+                    "Worker %d has not reported for %.0f s",
+                    worker.index, now - worker.updated)
+            sessions.extend(worker.stats["sessions"])
+            cpu_time += worker.stats["cpu_time"]
+            memory += worker.stats["max_rss"]
+            overruns += worker.stats["ticker"]["overruns"]
+            drift = max(drift, worker.stats["ticker"]["max_drift"])
+        received = sum(session["received"] for session in sessions)
+        idle_sent = sum(session["idle_sent"] for session in sessions)
+
+        # Rates are worked out from the change in totals since last time
+        totals, self.totals = self.totals, (
+            now, cpu_time, received, idle_sent, overruns)
+        if totals is None:
+            return
+        elapsed = now - totals[0]
+        self.logger.info(
+            "%d workers, %d sessions (%d connected, %d attached); "
+            "cpu: %.1f%%, peak memory: %.1f MB, received: %.1f KB/s, "
+            "idle sent: %.1f packets/s; tick overruns: %d, "
+            "max drift: %.1f ms",
+            sum(1 for worker in self.workers if worker.port is not None),
+            len(sessions),
+            sum(1 for session in sessions if session["connected"]),
+            sum(session["attached"] for session in sessions),
+            100 * max(0, cpu_time - totals[1]) / elapsed,
+            memory / 1048576.0,
+            max(0, received - totals[2]) / elapsed / 1024.0,
+            max(0, idle_sent - totals[3]) / elapsed,
+            max(0, overruns - totals[4]),
+            1000 * drift)
+
+
+# Restarts --------------------------------------------------------------------
+
+# A hot restart hands each session's connection to the server to a fresh copy
+# of this program, so new code can be deployed without logging in again.
+# Clients are disconnected, and reading from the server and accepting clients
+# stop. Once everything written to the server has been sent, a snapshot is
+# saved and the program is exec'd in place with the sockets left open. The
+# new program loads the snapshot and reads on from where this one stopped.
+
+class Restart(object):
+    poll_interval = 0.05
+    timeout = 10
+
+    def __init__(self):
+        self.logger = logging.getLogger("Restart")
+        self.logger.setLevel(log_level)
+        self.started = time.monotonic()
+        self.paused = False
+        self.call = task.LoopingCall(self.poll)
+
+    def start(self):
+        global restarting
+        if None in self.get_unsent():
+            self.logger.error(
+                "Can't tell what is left to send to the server with this "
+                "version of Twisted, restart abandoned")
+            restarting = None
+            return
+        self.logger.info("Restarting...")
+        for session in sessions:
+            for downstream in list(session.downstreams.members):
+                downstream.close("MineBNC is restarting")
+        self.call.start(self.poll_interval)
+
+    def poll(self):
+        elapsed = time.monotonic() - self.started
+        attached = [downstream for session in sessions
+                    for downstream in session.downstreams.members]
+        if attached:
+            if elapsed > self.timeout:
+                for downstream in attached:
+                    downstream.transport.abortConnection()
+            return
+
+        if not self.paused:
+            self.pause()
+        unsent = self.get_unsent()
+        if None in unsent:
+            self.logger.error(
+                "Can't tell what is left to send to the server, restart "
+                "abandoned")
+            self.resume()
+            return
+        if any(unsent):
+            if elapsed > 2 * self.timeout:
+                self.logger.error("Server is not reading, restart abandoned")
+                self.resume()
+            return
+
+        self.call.stop()
+        self.exec_snapshot()
+
+    def get_unsent(self):
+        return [get_unsent(session.upstream.transport)
+                for session in sessions if session.upstream is not None]
+
+    def pause(self):
+        self.paused = True
+        for listener in listeners.values():
+            listener.stopReading()
+        for session in sessions:
+            if session.upstream is not None:
+                session.upstream.ticker.stop()
+                session.upstream.transport.stopReading()
+
+    def resume(self):
+        global restarting
+        self.call.stop()
+        for listener in listeners.values():
+            listener.startReading()
+        for session in sessions:
+            if session.upstream is not None:
+                session.upstream.ticker.start()
+                session.upstream.transport.startReading()
+        restarting = None
+
+    def exec_snapshot(self):
+        state = {"listeners": {}, "sessions": {}}
+        for name, listener in listeners.items():
+            fd = listener.fileno()
+            os.set_inheritable(fd, True)
+            state["listeners"][name] = (fd, listener.socket.family)
+        for session in sessions:
+            session_state = session.get_snapshot()
+            if session_state is not None:
+                state["sessions"][session.name.lower()] = session_state
+        size = save_snapshot(restart_snapshot_path, state)
+        self.logger.info(
+            "Saved %d sessions (%.1f KB) in %.1f s, restarting",
+            len(state["sessions"]), size / 1024.0,
+            time.monotonic() - self.started)
+        os.execv(sys.executable, [
+            sys.executable, os.path.abspath(__file__),
+            "--restore", restart_snapshot_path])
+
+
+restarting = None
+
+
+def restart():
+    global restarting
+    if restarting is None:
+        restarting = Restart()
+        restarting.start()
+
+
+def get_unsent(transport):
+    # Returns the number of bytes written to a transport but not yet sent.
+    # Twisted doesn't make this public, so None is returned if its write
+    # buffer isn't where it has been until now.
+    try:
+        return len(transport.dataBuffer) - transport.offset + \
+            transport._tempDataLen
+    except (AttributeError, TypeError):
+        return None
+
+
+def get_accounts():
+    return [(display_name, connect_host, connect_port)] + list(accounts)
+
+
+def report_stats(report):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    report.write(json.dumps({
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        "max_rss": usage.ru_maxrss * 1024,
+        "ticker": wheel.get_stats(),
+        "sessions": [session.get_stats() for session in sessions]}) + "\n")
+
 
 @defer.inlineCallbacks
-def run():
-    profile = yield Profile.from_file(display_name)
+def run_worker(idx, count):
+    yield add_sessions(get_accounts()[idx::count])
+    factory = DownstreamFactory()
+    factory.relayed = True
+    factory.max_players = max_clients * len(sessions)
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+    if metrics_port:
+        listen_metrics(metrics_port + 1 + idx)
+    report = os.fdopen(3, "w", buffering=1)
+    report.write(json.dumps({"port": port.getHost().port}) + "\n")
+    task.LoopingCall(report_stats, report).start(Worker.report_interval)
+    for session in sessions:
+        session.connect()
+
+
+def listen_metrics(port):
+    return reactor.listenTCP(
+        port, Site(MetricsResource(sessions, wheel)),
+        interface="127.0.0.1")
+
+
+@defer.inlineCallbacks
+def add_sessions(accounts):
+    for name, host, port in accounts:
+        profile = yield Profile.from_file(name)
+        sessions.add(Session(profile, host, port))
+
+    # With a single account, any login name reaches it
+    if len(get_accounts()) == 1:
+        sessions.default = next(iter(sessions))
+
+
+listeners = {}
+
+
+@defer.inlineCallbacks
+def run(snapshot_path=None):
+    yield add_sessions(get_accounts())
     downstream_factory = DownstreamFactory()
-    downstream_factory.listen(listen_host, listen_port)
-    upstream_factory = UpstreamFactory(profile)
-    upstream_factory.connect(connect_host, connect_port)
+    downstream_factory.max_players = max_clients * len(sessions)
+    sessions.restart = restart
+    signal.signal(
+        signal.SIGHUP, lambda signum, frame: reactor.callFromThread(restart))
+
+    if snapshot_path is not None:
+        return resume(snapshot_path, downstream_factory)
+    listeners["clients"] = reactor.listenTCP(
+        listen_port, downstream_factory, interface=listen_host)
+    if metrics_port:
+        listeners["metrics"] = listen_metrics(metrics_port)
+    for session in sessions:
+        session.connect()
+
+
+def resume(snapshot_path, downstream_factory):
+    # Picks up the sockets and sessions left by a hot restart. Sessions that
+    # were not in game connect afresh.
+    start = time.monotonic()
+    state = load_snapshot(snapshot_path)
+    factories = {"clients": downstream_factory}
+    if metrics_port:
+        factories["metrics"] = Site(MetricsResource(sessions, wheel))
+    for name, (fd, family) in state["listeners"].items():
+        if name in factories:
+            listeners[name] = reactor.adoptStreamPort(
+                fd, family, factories[name])
+        os.close(fd)
+    if metrics_port and "metrics" not in listeners:
+        listeners["metrics"] = listen_metrics(metrics_port)
+
+    saved = state["sessions"]
+    count = 0
+    for session in sessions:
+        session_state = saved.pop(session.name.lower(), None)
+        if session_state is None:
+            session.connect()
+        else:
+            session.resume(session_state)
+            count += 1
+    for session_state in saved.values():
+        os.close(session_state["fd"])
+
+    logger = logging.getLogger("Restart")
+    logger.setLevel(log_level)
+    logger.info("Resumed %d sessions in %.1f s", count,
+                time.monotonic() - start)
 
 
 if __name__ == "__main__":
-    run()
+    if "--worker" in sys.argv:
+        idx = sys.argv.index("--worker")
+        run_worker(int(sys.argv[idx + 1]), int(sys.argv[idx + 2]))
+    elif "--restore" in sys.argv:
+        run(sys.argv[sys.argv.index("--restore") + 1])
+    elif workers:
+        Supervisor(get_accounts(), workers).start()
+    else:
+        run()
     reactor.run()
@@ -0,0 +1,92 @@
+"""
+Records the packets passing through a session to a compact trace file, and
+reads them back.
+
+A trace begins with a header giving the protocol version, the upstream
+compression threshold and the wall clock time at which recording began.
+Each record that follows has a fixed-size header giving the time since the
+start of recording, the kind of record, the packet ID and the length of the
+body, followed by the body itself:
+
+* ``downstream`` and ``upstream`` records hold the payload of a packet
+  received from the server or the controlling client, without its packet ID.
+* ``relay`` records hold a run of frames relayed from the server as-is,
+  compressed at the recorded threshold.
+
+Traces are read through ``mmap``, and each record body is copied out of the
+map only as it is read, so the reader can be closed at any time.
+"""
+
+import mmap
+import struct
+import time
+
+from quarry.data import packets
+
+
+header = struct.Struct('>8sIid')
+record = struct.Struct('>dBHI')
+magic = b"MBNCTRC1"
+kinds = ("downstream", "upstream", "relay")
+
+
+class TraceWriter(object):
+    def __init__(self, path, protocol_version, compression_threshold):
+        self.file = open(path, 'wb', buffering=1048576)
+        self.protocol_version = protocol_version
+        self.start = time.monotonic()
+        self.file.write(header.pack(
+            magic, protocol_version, compression_threshold, time.time()))
+
+    def write_packet(self, direction, name, buff):
+        ident = packets.packet_idents[
+            self.protocol_version, "play", direction, name]
+        body = memoryview(buff.buff)[buff.pos:]
+        self.file.write(record.pack(
+            time.monotonic() - self.start, kinds.index(direction), ident,
+            len(body)))
+        self.file.write(body)
+
+    def write_frames(self, data):
+        self.file.write(record.pack(
+            time.monotonic() - self.start, 2, 0, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class TraceReader(object):
+    def __init__(self, path):
+        with open(path, 'rb') as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, self.protocol_version, self.compression_threshold, \
+            self.started = header.unpack_from(self.map)
+        if file_magic != magic:
+            raise ValueError("Not a packet trace: %s" % path)
+
+    def __iter__(self):
+        """
+        Yields a ``(time, kind, name, body)`` tuple for each record, where
+        *name* is None for relayed frames and *body* is ``bytes``.
+        """
+
+        names = {}
+        for (version, mode, direction, ident), name in \
+                packets.packet_names.items():
+            if version == self.protocol_version and mode == "play":
+                names[kinds.index(direction), ident] = name
+
+        pos = header.size
+        end = len(self.map)
+        while pos + record.size <= end:
+            when, kind, ident, length = record.unpack_from(self.map, pos)
+            pos += record.size
+            if pos + length > end:
+                break
+            yield (when, kinds[kind], names.get((kind, ident)),
+                   self.map[pos:pos + length])
+            pos += length
+
+    def close(self):
+        self.map.close()
@@ -1,3 +1,12 @@
+import collections
+import sys
+from time import monotonic
+
+import numpy
+
+from quarry.data import packets
+
+
 class Plugin(object):
     def __init__(self, buff_type, ticker, upstream):
         self.bt = buff_type
@@ -5,6 +14,7 @@ class Plugin(object):
         self.upstream = upstream
         self.downstream = None
         self.forwarding = False
+        self.prepared = []
         self.setup()
 
     def set_downstream(self, downstream):
@@ -13,6 +23,70 @@ class Plugin(object):
     def set_forwarding(self, forwarding):
         self.forwarding = forwarding
 
+    def get_plugin(self, plugin_type):
+        for plugin in self.upstream.plugins:
+            if isinstance(plugin, plugin_type):
+                return plugin
+
+    # Packets that are expensive to encode can be prepared in the background
+    # while detached, so attach need only write out ready-made frames.
+
+    def add_prepared(self, name, encode):
+        packet = PreparedPacket(self, name, encode)
+        self.prepared.append(packet)
+        return packet
+
+    def pack_frame(self, name, data, threshold):
+        ident = packets.packet_idents[
+            self.upstream.protocol_version, "play", "downstream", name]
+        return self.bt.pack_packet(
+            self.bt.pack_varint(ident) + data, threshold)
+
+    def prepare(self):
+        threshold = self.upstream.compression_threshold
+        for packet in self.prepared:
+            if packet.changed is not None:
+                packet.prepare(threshold)
+
+    def get_staleness(self):
+        # Returns the number of items not yet prepared, and the time at which
+        # the oldest of them changed
+        changed = [packet.changed for packet in self.prepared
+                   if packet.changed is not None]
+        return len(changed), min(changed, default=None)
+
+    def get_memory(self):
+        # Returns a rough estimate of this plugin's memory use, in bytes. Other
+        # plugins and the connections are not counted.
+        seen = set(id(plugin) for plugin in self.upstream.plugins)
+        seen.update(id(obj) for obj in (
+            self.bt, self.ticker, self.upstream, self.downstream))
+        return get_size(vars(self), seen)
+
+    # State is carried over a hot restart as a dict of attributes set up by
+    # the plugin. Connections are set up afresh, and prepared packets keep
+    # only their payload, as frames depend on the client.
+
+    unsaved = ('bt', 'ticker', 'upstream', 'downstream', 'forwarding',
+               'prepared')
+
+    def get_state(self):
+        state = {key: value for key, value in vars(self).items()
+                 if key not in self.unsaved and
+                 not isinstance(value, PreparedPacket)}
+        state['prepared'] = [(packet.payload, packet.changed is not None)
+                             for packet in self.prepared]
+        return state
+
+    def set_state(self, state):
+        state = dict(state)
+        prepared = state.pop('prepared', ())
+        vars(self).update(state)
+        for packet, (payload, stale) in zip(self.prepared, prepared):
+            packet.payload = payload
+            if stale:
+                packet.invalidate()
+
     def setup(self):
         pass
 
@@ -22,6 +96,141 @@ class Plugin(object):
     def detach(self):
         pass
 
+    def remove_downstream(self, downstream):
+        pass
+
+    def player_changed_chunk(self):
+        pass
+
+    def close(self):
+        # Called when the connection to the server is lost
+        pass
+
+
+class PreparedPacket(object):
+    def __init__(self, plugin, name, encode):
+        self.plugin = plugin
+        self.name = name
+        self.encode = encode
+        self.payload = None
+        self.frame = None
+        self.threshold = None
+        self.changed = None
+
+    def invalidate(self):
+        self.payload = None
+        self.frame = None
+        if self.changed is None:
+            self.changed = monotonic()
+
+    def prepare(self, threshold):
+        self.changed = None
+        if self.payload is None:
+            self.payload = self.encode()
+        if self.frame is None or self.threshold != threshold:
+            self.frame = self.plugin.pack_frame(
+                self.name, self.payload, threshold)
+            self.threshold = threshold
+
+    def send(self):
+        downstream = self.plugin.downstream
+        self.prepare(downstream.compression_threshold)
+        downstream.send_frame(self.frame)
+
+
+class PacketCache(object):
+    # The latest payload of a packet by key, such as a boss bar's UUID, kept
+    # as a list of encoded fields. Partial updates replace fields, and attach
+    # sends the payloads as they stand, so nothing is decoded or re-encoded.
+
+    def __init__(self, name):
+        self.name = name
+        self.payloads = {}
+
+    def set(self, key, *fields):
+        self.payloads[key] = list(fields)
+
+    def patch(self, key, index, field):
+        # Updates to payloads not yet set are dropped
+        fields = self.payloads.get(key)
+        if fields is not None:
+            fields[index] = field
+
+    def remove(self, key):
+        self.payloads.pop(key, None)
+
+    def send(self, downstream):
+        for fields in self.payloads.values():
+            downstream.send_packet(self.name, *fields)
+
+
+def read_varint(buff):
+    """
+    Reads a varint from a buffer without decoding it, and returns its bytes.
+    """
+
+    data = buff.buff
+    end = buff.pos
+    while data[end] & 0x80:
+        end += 1
+    return buff.read(end + 1 - buff.pos)
+
+
+def read_string(buff):
+    """
+    Reads a string, including its length prefix, from a buffer without
+    decoding it, and returns its bytes.
+    """
+
+    start = buff.pos
+    buff.read(buff.unpack_varint())
+    return buff.buff[start:buff.pos]
+
+
+def get_size(obj, seen):
+    """
+    Returns the size in bytes of an object and everything it holds, skipping
+    objects whose ``id()`` is in *seen*. Only containers and instances of
+    plugin classes are followed.
+    """
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += get_size(key, seen) + get_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        for item in obj:
+            size += get_size(item, seen)
+    elif isinstance(obj, numpy.ndarray):
+        if obj.base is not None:
+            size += get_size(obj.base, seen)
+    elif type(obj).__module__.split(".")[0] == "plugins":
+        if hasattr(obj, "__dict__"):
+            size += get_size(vars(obj), seen)
+        for name in getattr(obj, "__slots__", ()):
+            size += get_size(getattr(obj, name, None), seen)
+    return size
+
+
+def get_handlers(plugins):
+    """
+    Builds a dispatch table from a list of plugin instances. The table maps
+    ``(direction, packet name)`` to a list of bound ``packet_*`` handlers, in
+    plugin order.
+    """
+
+    handlers = {}
+    for plugin in plugins:
+        for attr in dir(plugin):
+            if attr.startswith("packet_"):
+                direction, name = attr[7:].split("_", 1)
+                handlers.setdefault((direction, name), []).append(
+                    getattr(plugin, attr))
+    return handlers
+
 from plugins.abilities import AbilitiesPlugin
 from plugins.boss_bar import BossBarPlugin
 from plugins.channel import ChannelPlugin
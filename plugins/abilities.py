@@ -1,41 +1,20 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache
 
 
 class AbilitiesPlugin(Plugin):
+    # Fields are the flags byte, then the flying speed and FOV modifier
+
     def setup(self):
-        self.invulnerable = False
-        self.flying = False
-        self.allow_flying = False
-        self.creative_mode = False
-        self.flying_speed = 0
-        self.fov_modifier = 0
+        self.abilities = PacketCache('player_abilities')
 
     def attach(self):
-        self.downstream.send_packet(
-            'player_abilities',
-            self.bt.pack(
-                'Bff',
-                self.invulnerable  << 0 |
-                self.flying        << 1 |
-                self.allow_flying  << 2 |
-                self.creative_mode << 3,
-                self.flying_speed,
-                self.fov_modifier))
+        self.abilities.send(self.downstream)
 
     def packet_downstream_player_abilities(self, buff):
-        flags = buff.unpack('B')
-        self.invulnerable = bool(flags & 1)
-        self.flying = bool(flags & 2)
-        self.allow_flying = bool(flags & 4)
-        self.creative_mode = bool(flags & 8)
-        self.flying_speed = buff.unpack('f')
-        self.fov_modifier = buff.unpack('f')
+        self.abilities.set(None, buff.read(1), buff.read())
 
     def packet_upstream_player_abilities(self, buff):
-        flags = buff.unpack('B')
-        self.invulnerable  = bool(flags & 1)
-        self.flying        = bool(flags & 2)
-        self.allow_flying  = bool(flags & 4)
-        self.creative_mode = bool(flags & 8)
-        self.flying_speed  = buff.unpack('f')
-        self.fov_modifier  = buff.unpack('f')
+        # The client reports its flags when it starts or stops flying. Its
+        # speeds are its walking and flying speeds, which aren't kept.
+        self.abilities.patch(None, 0, buff.read(1))
+        buff.discard()
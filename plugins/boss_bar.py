@@ -1,46 +1,36 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache, read_varint, read_string
 
 
 class BossBarPlugin(Plugin):
+    # Boss bars are keyed by their encoded UUID. Fields are as in the "add"
+    # action: the UUID and action, the title, the health, the colour and
+    # dividers, and the flags.
+
     def setup(self):
-        self.boss_bars = {}
+        self.boss_bars = PacketCache('boss_bar')
 
     def attach(self):
-        for boss_bar in self.boss_bars.values():
-            self.downstream.send_packet(
-                'boss_bar',
-                self.bt.pack_uuid(boss_bar['uuid']),
-                self.bt.pack_varint(0),
-                self.bt.pack_chat(boss_bar['title']),
-                self.bt.pack('f', boss_bar['health']),
-                self.bt.pack_varint(boss_bar['color']),
-                self.bt.pack_varint(boss_bar['dividers']),
-                self.bt.pack('B', boss_bar['flags']))
+        self.boss_bars.send(self.downstream)
 
     def packet_downstream_boss_bar(self, buff):
-        uuid = buff.unpack_uuid()
+        uuid = buff.read(16)
         action = buff.unpack_varint()
         if action == 0:
             # Create boss bar
-            self.boss_bars[uuid] = {'uuid': uuid}
+            self.boss_bars.set(
+                uuid,
+                uuid + self.bt.pack_varint(0),
+                read_string(buff),
+                buff.read(4),
+                read_varint(buff) + read_varint(buff),
+                buff.read(1))
         elif action == 1:
-            del self.boss_bars[uuid]
-            return
-
-        boss_bar = self.boss_bars[uuid]
-
-        if action == 0:
-            boss_bar['title'] = buff.unpack_chat()
-            boss_bar['health'] = buff.unpack('f')
-            boss_bar['color'] = buff.unpack_varint()
-            boss_bar['dividers'] = buff.unpack_varint()
-            boss_bar['flags'] = buff.unpack('B')
+            self.boss_bars.remove(uuid)
         elif action == 2:
-            boss_bar['health'] = buff.unpack('f')
+            self.boss_bars.patch(uuid, 2, buff.read(4))
         elif action == 3:
-            boss_bar['title'] = buff.unpack_chat()
+            self.boss_bars.patch(uuid, 1, read_string(buff))
         elif action == 4:
-            boss_bar['color'] = buff.unpack_varint()
-            boss_bar['dividers'] = buff.unpack_varint()
+            self.boss_bars.patch(uuid, 3, buff.read())
         elif action == 5:
-            boss_bar['flags'] = buff.unpack('B')
+            self.boss_bars.patch(uuid, 4, buff.read(1))
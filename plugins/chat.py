@@ -1,45 +1,234 @@
+import collections
+import datetime
+import json
+import os
+import re
+import struct
+import time
+
 from twisted.internet import reactor
+from quarry.types.chat import Message
+
+from config import scrollback_limit, chat_log_path
 from plugins import Plugin
+from plugins.world import WorldPlugin
+from timer_wheel import wheel
+
+
+class ChatLog(object):
+    # An append-only log of chat messages, one "<time>\t<json>" line each,
+    # alongside an index file of fixed-size (time, offset) records. The index
+    # allows seeking by time, and reading the log backwards in blocks,
+    # without loading either file into memory.
+
+    record = struct.Struct('>dQ')
+    block = 1024
+
+    def __init__(self, path):
+        self.log = open(path, 'ab+')
+        self.index = open(path + '.idx', 'ab+')
+        self.count = self.index.seek(0, os.SEEK_END) // self.record.size
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+    def append(self, when, message):
+        offset = self.log.seek(0, os.SEEK_END)
+        self.log.write(b"%.3f\t%s\n" % (
+            when, json.dumps(message.value).encode('utf8')))
+        self.log.flush()
+        self.index.write(self.record.pack(when, offset))
+        self.index.flush()
+        self.count += 1
 
+    def get_record(self, idx):
+        return self.record.unpack(os.pread(
+            self.index.fileno(), self.record.size, idx * self.record.size))
+
+    def read(self, start, stop):
+        # Returns a list of (time, message) tuples for records [start, stop)
+        if start >= stop:
+            return []
+        offset = self.get_record(start)[1]
+        if stop < self.count:
+            end = self.get_record(stop)[1]
+        else:
+            end = self.log.seek(0, os.SEEK_END)
+        data = os.pread(self.log.fileno(), end - offset, offset)
+        messages = []
+        for line in data.splitlines():
+            when, value = line.split(b"\t", 1)
+            messages.append((float(when), Message(json.loads(value))))
+        return messages
+
+    def since(self, when, count):
+        # Returns up to count messages from the given time onwards
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_record(mid)[0] < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.read(lo, min(lo + count, self.count))
+
+    def search(self, query, count):
+        # Returns up to count of the latest messages containing the query
+        query = query.lower()
+        matches = []
+        stop = self.count
+        while stop > 0 and len(matches) < count:
+            start = max(0, stop - self.block)
+            for when, message in reversed(self.read(start, stop)):
+                if query in message.to_string().lower():
+                    matches.append((when, message))
+                    if len(matches) == count:
+                        break
+            stop = start
+        return matches[::-1]
 
 
 class ChatPlugin(Plugin):
+    history_count = 20
+    unsaved = Plugin.unsaved + ('log',)
+
     def setup(self):
-        self.messages = []
-        self.scrollback_limit = 100
+        self.messages = collections.deque(maxlen=scrollback_limit)
+        self.log = None
+        if chat_log_path:
+            self.log = ChatLog(chat_log_path.format(
+                name=self.upstream.session.name))
 
     def attach(self):
-        if self.messages:
-            self.messages.append(u"\u00a7a--- end scrollback ---")
+        # The scrollback is kept, so every client attaching gets it
         for message in self.messages:
             self.downstream.send_packet(
                 'chat_message',
                 self.bt.pack_chat(message),
                 self.bt.pack('b', 0))
-        del self.messages[:]
+        if self.messages:
+            self.downstream.send_packet(
+                'chat_message',
+                self.bt.pack_chat(u"\u00a7a--- end scrollback ---"),
+                self.bt.pack('b', 0))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
 
     def command(self, subcommand=None, *args):
         if subcommand is None:
-            return "subcommands: stop"
+            return "subcommands: stop, restart, world, history, sessions, " \
+                "stats"
         elif subcommand == "stop":
             reactor.stop()
+        elif subcommand == "restart":
+            return self.restart()
+        elif subcommand == "world":
+            return self.get_plugin(WorldPlugin).describe()
+        elif subcommand == "history":
+            return self.history(" ".join(args))
+        elif subcommand == "sessions":
+            return self.list_sessions()
+        elif subcommand == "stats":
+            return self.stats(*args)
+
+    def list_sessions(self):
+        registry = self.upstream.session.registry
+        for session in registry:
+            self.downstream.send_packet(
+                'chat_message',
+                self.bt.pack_chat(session.describe()),
+                self.bt.pack('b', 1))
+        self.downstream.send_packet(
+            'chat_message',
+            self.bt.pack_chat(wheel.describe()),
+            self.bt.pack('b', 1))
+        return u"\u00a7a--- %d sessions ---" % len(registry)
+
+    def restart(self):
+        restart = self.upstream.session.registry.restart
+        if restart is None:
+            return "restart: not available with workers"
+        reactor.callLater(0, restart)
+        return "restart: handing over to a new process"
+
+    def stats(self, *args):
+        metrics = self.upstream.session.metrics
+        if metrics is None:
+            return "stats: metrics_enabled is not set"
+        if args == ("reset",):
+            metrics.reset()
+            return "stats: counters reset"
+        if args:
+            return "usage: /minebnc stats [reset]"
+        for line in metrics.describe():
+            self.downstream.send_packet(
+                'chat_message',
+                self.bt.pack_chat(line),
+                self.bt.pack('b', 1))
+
+    # History can be searched with '/minebnc history <text>', or paged
+    # through with '/minebnc history <since>', where <since> is a duration
+    # such as '90s', '15m' or '2h', or a time of day such as '18:30'.
+
+    def history(self, query):
+        if self.log is None:
+            return "history: chat_log_path is not set"
+        if not query:
+            return "usage: /minebnc history <text|15m|18:30>"
+
+        since = self.parse_since(query)
+        if since is None:
+            messages = self.log.search(query, self.history_count)
+        else:
+            messages = self.log.since(since, self.history_count)
 
+        for when, message in messages:
+            self.downstream.send_packet(
+                'chat_message',
+                self.bt.pack_chat(u"\u00a77[%s]\u00a7r %s" % (
+                    time.strftime("%H:%M:%S", time.localtime(when)),
+                    message.to_string(strip_styles=False))),
+                self.bt.pack('b', 1))
+        return u"\u00a7a--- %d messages ---" % len(messages)
+
+    def parse_since(self, text):
+        match = re.match(r'^(\d+)([smhd])$', text)
+        if match:
+            units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+            return time.time() - int(match.group(1)) * units[match.group(2)]
+        match = re.match(r'^(\d{1,2}):(\d{2})$', text)
+        if match:
+            now = datetime.datetime.now()
+            try:
+                when = now.replace(
+                    hour=int(match.group(1)), minute=int(match.group(2)),
+                    second=0, microsecond=0)
+            except ValueError:
+                return None
+            if when > now:
+                when -= datetime.timedelta(days=1)
+            return when.timestamp()
 
     def packet_downstream_chat_message(self, buff):
         message = buff.unpack_chat()
         position = buff.unpack('b')
         if position in (0, 1):
             self.messages.append(message)
-            if len(self.messages) > self.scrollback_limit:
-                self.messages.pop(0)
+            if self.log is not None:
+                self.log.append(time.time(), message)
 
     def packet_upstream_chat_message(self, buff):
         request = buff.unpack_string()
         args = request.split()
         if args[0] == "/minebnc":
             response = self.command(*args[1:])
-            self.downstream.send_packet(
-                "chat_message",
-                self.bt.pack(0),
-                self.bt.pack_chat(response))
-            return True
\ No newline at end of file
+            if response:
+                self.downstream.send_packet(
+                    "chat_message",
+                    self.bt.pack_chat(response),
+                    self.bt.pack('b', 1))
+            return True
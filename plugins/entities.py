@@ -1,5 +1,9 @@
-from collections import defaultdict
-from plugins import Plugin
+import math
+
+from quarry.types.buffer import Buffer1_13, Buffer1_14
+
+from config import idle_update_interval
+from plugins import Plugin, read_varint, read_string
 
 
 def f2b(n):
@@ -10,132 +14,285 @@ def b2f(n):
     return n * 360.0 / 256.0
 
 
+# Entity metadata is kept as a dict of index to encoded entry, so updates
+# are merged by index and attach need only join the entries. Entries are
+# split by type without decoding their values, except for slots, NBT and
+# particles, which are unpacked to find their end.
+
+metadata_sizes = {
+    'byte': 1, 'float': 4, 'boolean': 1, 'rotation': 12, 'position': 8,
+    'uuid': 16}
+
+metadata_types_1_9 = (
+    'byte', 'varint', 'float', 'string', 'chat', 'slot', 'boolean',
+    'rotation', 'position', 'opt_position', 'direction', 'opt_uuid',
+    'block', 'nbt')
+
+metadata_types_1_13 = (
+    'byte', 'varint', 'float', 'string', 'chat', 'opt_chat', 'slot',
+    'boolean', 'rotation', 'position', 'opt_position', 'direction',
+    'opt_uuid', 'block', 'nbt', 'particle')
+
+metadata_types_1_14 = metadata_types_1_13 + (
+    'villager', 'opt_varint', 'pose')
+
+
+def get_metadata_types(buff_type):
+    if issubclass(buff_type, Buffer1_14):
+        return metadata_types_1_14
+    elif issubclass(buff_type, Buffer1_13):
+        return metadata_types_1_13
+    return metadata_types_1_9
+
+
+def read_metadata(buff, types):
+    metadata = {}
+    data = buff.buff
+    while True:
+        start = buff.pos
+        index = data[start]
+        buff.pos += 1
+        if index == 255:
+            return metadata
+        kind = types[data[start + 1]]
+        buff.pos += 1
+        size = metadata_sizes.get(kind)
+        if size is None:
+            skip_metadata(buff, kind)
+        else:
+            buff.read(size)
+        metadata[index] = data[start:buff.pos]
+
+
+def skip_metadata(buff, kind):
+    size = metadata_sizes.get(kind)
+    if size is not None:
+        buff.read(size)
+    elif kind in ('varint', 'direction', 'block', 'opt_varint', 'pose'):
+        read_varint(buff)
+    elif kind == 'villager':
+        for _ in range(3):
+            read_varint(buff)
+    elif kind in ('string', 'chat'):
+        read_string(buff)
+    elif kind.startswith('opt_'):
+        if buff.unpack('?'):
+            skip_metadata(buff, kind[4:])
+    else:
+        getattr(buff, 'unpack_' + kind)()
+
+
+class Entity(object):
+    __slots__ = (
+        # Common
+        'id', 'type', 'uuid', 'chunk', 'x', 'y', 'z', 'yaw', 'pitch',
+        'head_yaw', 'on_ground', 'dx', 'dy', 'dz', 'metadata',
+        'equipment', 'effects', 'properties', 'passengers', 'attached', 'bed',
+
+        # Type-specific
+        'mob_type', 'head_pitch', 'object_type', 'object_data',
+        'painting_type', 'painting_direction', 'global_entity_type',
+        'experience_count',
+
+        # Client player
+        'vehicle', 'actions')
+
+    def __init__(self, entity_type, entity_id=0):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.type = entity_type
+        self.id = entity_id
+        self.x = self.y = self.z = 0.0
+        self.yaw = self.pitch = 0.0
+        self.dx = self.dy = self.dz = 0
+        self.on_ground = True
+
+
 class EntitiesPlugin(Plugin):
+    wake_ticks = 20
+
     def setup(self):
-        self.entities = defaultdict(lambda: {
-            "type": "unknown",
-            "x": 0,
-            "y": 0,
-            "z": 0,
-        })
-        self.player = {
-            'type': 'client',
-            'id': 0,
-            'x': 0,
-            'y': 0,
-            'z': 0,
-            'yaw': 0,
-            'pitch': 0,
-            'on_ground': True,
-            'actions': {},
-        }
+        self.entities = {}
+        self.index = {}
+        self.dimension = 0
+        self.player = Entity('client')
+        self.player.actions = {}
+        self.move_entity(self.player, 0.0, 0.0, 0.0)
         self.spawned = False
+        self.update_interval = 1
+        self.update_ticks = 0
+        self.wake_remaining = 0
+        self.player_moved = True
+        self.metadata_types = get_metadata_types(self.bt)
+
+    def set_state(self, state):
+        super(EntitiesPlugin, self).set_state(state)
+        if self.spawned:
+            self.ticker.add_loop(1, self.update_player)
+
+    # Entities are created only by spawn packets and removed by 'Destroy
+    # Entities' or a change of dimension. Packets about unknown entities are
+    # ignored. Each entity is indexed by the chunk it stands in.
+
+    def add_entity(self, entity):
+        self.remove_entity(entity.id)
+        self.entities[entity.id] = entity
+        self.move_entity(entity, entity.x, entity.y, entity.z)
+
+    def remove_entity(self, entity_id):
+        entity = self.entities.pop(entity_id, None)
+        if entity is not None and entity is not self.player:
+            self.unindex_entity(entity)
+
+    def get_entity(self, entity_id, buff):
+        entity = self.entities.get(entity_id)
+        if entity is None:
+            buff.discard()
+        return entity
+
+    def move_entity(self, entity, x, y, z):
+        entity.x, entity.y, entity.z = x, y, z
+        chunk = (int(math.floor(x)) >> 4, int(math.floor(z)) >> 4)
+        if chunk != entity.chunk:
+            self.unindex_entity(entity)
+            entity.chunk = chunk
+            self.index.setdefault(chunk, set()).add(entity)
+
+    def move_player(self, x, y, z):
+        chunk = self.player.chunk
+        self.move_entity(self.player, x, y, z)
+        if self.player.chunk != chunk:
+            for plugin in self.upstream.plugins:
+                plugin.player_changed_chunk()
+
+    def unindex_entity(self, entity):
+        chunk = self.index.get(entity.chunk)
+        if chunk is not None:
+            chunk.discard(entity)
+            if not chunk:
+                del self.index[entity.chunk]
+
+    def get_nearby(self, radius=None):
+        # Yields entities in order of chunk distance from the player
+        player_x, player_z = self.player.chunk
+
+        def distance(coords):
+            dx, dz = coords[0] - player_x, coords[1] - player_z
+            return max(abs(dx), abs(dz)), dx * dx + dz * dz
+
+        for coords in sorted(self.index, key=distance):
+            if radius is not None and distance(coords)[0] > radius:
+                break
+            for entity in self.index[coords]:
+                if entity is not self.player:
+                    yield entity
 
     def attach(self):
-        for entity in self.entities.values():
+        entities = list(self.get_nearby())
+        for entity in entities:
             # Send 'Spawn Player'
-            if entity['type'] == 'player':
+            if entity.type == 'player':
                 self.downstream.send_packet(
                     'spawn_player',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack_uuid(entity['uuid']),
-                    self.bt.pack('ddd', entity['x'], entity['y'], entity['z']),
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack_uuid(entity.uuid),
+                    self.bt.pack('ddd', entity.x, entity.y, entity.z),
                     self.bt.pack(
                         'BB',
-                        f2b(entity['yaw']),
-                        f2b(entity['pitch'])),
-                    self.bt.pack_entity_metadata(entity['metadata']))
+                        f2b(entity.yaw),
+                        f2b(entity.pitch)),
+                    self.pack_metadata(entity))
 
             # Send 'Spawn Mob'
-            elif entity['type'] == 'mob':
+            elif entity.type == 'mob':
                 self.downstream.send_packet(
                     'spawn_mob',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack_uuid(entity['uuid']),
-                    self.bt.pack_varint(entity['mob_type']),
-                    self.bt.pack('ddd', entity['x'], entity['y'], entity['z']),
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack_uuid(entity.uuid),
+                    self.bt.pack_varint(entity.mob_type),
+                    self.bt.pack('ddd', entity.x, entity.y, entity.z),
                     self.bt.pack(
                         'BBB',
-                        f2b(entity['yaw']),
-                        f2b(entity['pitch']),
-                        f2b(entity['head_pitch'])),
+                        f2b(entity.yaw),
+                        f2b(entity.pitch),
+                        f2b(entity.head_pitch)),
                     self.bt.pack(
                         'hhh',
-                        entity['dx'],
-                        entity['dy'],
-                        entity['dz']),
-                    self.bt.pack_entity_metadata(entity['metadata']))
+                        entity.dx,
+                        entity.dy,
+                        entity.dz),
+                    self.pack_metadata(entity))
 
             # Send 'Spawn Object'
-            elif entity['type'] == 'object':
+            elif entity.type == 'object':
                 self.downstream.send_packet(
                     'spawn_object',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack_uuid(entity['uuid']),
-                    self.bt.pack('b', entity['object_type']),
-                    self.bt.pack('ddd', entity['x'], entity['y'], entity['z']),
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack_uuid(entity.uuid),
+                    self.bt.pack('b', entity.object_type),
+                    self.bt.pack('ddd', entity.x, entity.y, entity.z),
                     self.bt.pack(
                         'BB',
-                        f2b(entity['pitch']),
-                        f2b(entity['yaw'])),
-                    self.bt.pack('i', entity['object_data']),
+                        f2b(entity.pitch),
+                        f2b(entity.yaw)),
+                    self.bt.pack('i', entity.object_data),
                     self.bt.pack(
                         'hhh',
-                        entity['dx'],
-                        entity['dy'],
-                        entity['dz']))
+                        entity.dx,
+                        entity.dy,
+                        entity.dz))
 
             # Send 'Spawn Painting'
-            elif entity['type'] == 'painting':
+            elif entity.type == 'painting':
                 self.downstream.send_packet(
                     'spawn_painting',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack_uuid(entity['uuid']),
-                    self.bt.pack_string(entity['painting_type']),
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack_uuid(entity.uuid),
+                    self.bt.pack_string(entity.painting_type),
                     self.bt.pack_position(
-                        entity['x'],
-                        entity['y'],
-                        entity['z']),
-                    self.bt.pack('b', entity['painting_direction']))
+                        entity.x,
+                        entity.y,
+                        entity.z),
+                    self.bt.pack('b', entity.painting_direction))
 
             # Send 'Spawn Global Entity'
-            elif entity['type'] == 'global_entity':
+            elif entity.type == 'global_entity':
                 self.downstream.send_packet(
                     'spawn_global_entity',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack('b', entity['global_entity_type']),
-                    self.bt.pack('ddd', entity['x'], entity['y'], entity['z']))
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack('b', entity.global_entity_type),
+                    self.bt.pack('ddd', entity.x, entity.y, entity.z))
 
             # Send 'Spawn Experience Orb'
-            elif entity['type'] == 'experience_orb':
+            elif entity.type == 'experience_orb':
                 self.downstream.send_packet(
                     'spawn_experience_orb',
-                    self.bt.pack_varint(entity['id']),
-                    self.bt.pack('ddd', entity['x'], entity['y'], entity['z']),
-                    self.bt.pack('h', entity['experience_count']))
+                    self.bt.pack_varint(entity.id),
+                    self.bt.pack('ddd', entity.x, entity.y, entity.z),
+                    self.bt.pack('h', entity.experience_count))
 
         # Set up entities
-        for entity in self.entities.values():
+        for entity in entities:
             # Send 'Entity Equipment'
-            for idx, equipment in enumerate(entity.get('equipment', [])):
+            for idx, equipment in enumerate(entity.equipment or ()):
                 if equipment['item'] is not None:
                     self.downstream.send_packet(
                         'entity_equipment',
-                        self.bt.pack_varint(entity['id']),
+                        self.bt.pack_varint(entity.id),
                         self.bt.pack_varint(idx),
                         self.bt.pack_slot(**equipment))
 
             # Send 'Entity Effects'
-            for effect in entity.get('effects', {}).values():
+            for effect in (entity.effects or {}).values():
                 self.downstream.send_packet(
                     'entity_effect',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack('bb', effect['id'], effect['amplifier']),
                     self.bt.pack_varint(effect['duration']),
                     self.bt.pack('b', effect['flags']))
 
             # Send 'Entity Properties'
-            properties = entity.get('properties', {})
+            properties = entity.properties
             if properties:
                 out = b""
                 for property in properties.values():
@@ -149,42 +306,42 @@ class EntitiesPlugin(Plugin):
 
                 self.downstream.send_packet(
                     'entity_properties',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack('i', len(properties)),
                     out)
 
             # Send 'Set Passengers'
-            passengers = entity.get('passengers', [])
+            passengers = entity.passengers
             if passengers:
                 self.downstream.send_packet(
                     'set_passengers',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack_varint(len(passengers)),
                     *[self.bt.pack_varint(passenger)
                       for passenger in passengers])
 
             # Send 'Attach Entity'
-            attached = entity.get('attached')
+            attached = entity.attached
             if attached:
                 self.downstream.send_packet(
                     'entity_attach',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack_varint(attached))
 
             # Send 'Use Bed'
-            bed = entity.get('bed')
+            bed = entity.bed
             if bed:
                 self.downstream.send_packet(
                     'use_bed',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack_position(*bed))
 
             # Send 'Entity Head Look'
-            head_yaw = entity.get('head_yaw')
+            head_yaw = entity.head_yaw
             if head_yaw:
                 self.downstream.send_packet(
                     'entity_head_look',
-                    self.bt.pack_varint(entity['id']),
+                    self.bt.pack_varint(entity.id),
                     self.bt.pack('B', f2b(head_yaw)))
 
         # Send 'Player Position And Look'
@@ -192,11 +349,11 @@ class EntitiesPlugin(Plugin):
             'player_position_and_look',
             self.bt.pack(
                 'dddff',
-                self.player['x'],
-                self.player['y'],
-                self.player['z'],
-                self.player['yaw'],
-                self.player['pitch']),
+                self.player.x,
+                self.player.y,
+                self.player.z,
+                self.player.yaw,
+                self.player.pitch),
             self.bt.pack('b', 0),
             self.bt.pack_varint(0))
 
@@ -208,172 +365,231 @@ class EntitiesPlugin(Plugin):
         ]
 
         for action_id, field in actions:
-            if self.player['actions'].get(field, False):
+            if self.player.actions.get(field, False):
                 self.upstream.send_packet(
                     'entity_action',
-                    self.bt.pack_varint(self.player['id']),
+                    self.bt.pack_varint(self.player.id),
                     self.bt.pack_varint(action_id))
 
+        # The client may have moved the player
+        self.wake_updates()
+
     # Entity spawning ---------------------------------------------------------
 
     def packet_downstream_join_game(self, buff):
-        self.player['id'] = buff.unpack('i')
-        self.entities[self.player['id']] = self.player
+        self.player.id = buff.unpack('i')
+        buff.unpack('b')
+        self.dimension = buff.unpack('i')
+        self.entities[self.player.id] = self.player
+        buff.discard()
+
+    def packet_downstream_respawn(self, buff):
+        dimension = buff.unpack('i')
         buff.discard()
 
+        # The client discards its entities when changing dimension
+        if dimension != self.dimension:
+            for entity_id in list(self.entities):
+                if entity_id != self.player.id:
+                    self.remove_entity(entity_id)
+        self.dimension = dimension
+        self.wake_updates()
+
     def packet_downstream_spawn_player(self, buff):
-        entity = {'type': 'player'}
-        entity['id'] = buff.unpack_varint()
-        entity['uuid'] = buff.unpack_uuid()
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        entity['yaw'], entity['pitch'] = buff.unpack('BB')
-        entity['metadata'] = buff.unpack_entity_metadata()
-        self.entities[entity['id']] = entity
+        entity = Entity('player', buff.unpack_varint())
+        entity.uuid = buff.unpack_uuid()
+        entity.x, entity.y, entity.z = buff.unpack('ddd')
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.metadata = read_metadata(buff, self.metadata_types)
+        self.add_entity(entity)
 
     def packet_downstream_spawn_mob(self, buff):
-        entity = {'type': 'mob'}
-        entity['id'] = buff.unpack_varint()
-        entity['uuid'] = buff.unpack_uuid()
-        entity['mob_type'] = buff.unpack_varint()
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        entity['yaw'] = b2f(buff.unpack('B'))
-        entity['pitch'] = b2f(buff.unpack('B'))
-        entity['head_pitch'] = b2f(buff.unpack('B'))
-        entity['dx'], entity['dy'], entity['dz'] = buff.unpack('hhh')
-        entity['metadata'] = buff.unpack_entity_metadata()
-        self.entities[entity['id']] = entity
+        entity = Entity('mob', buff.unpack_varint())
+        entity.uuid = buff.unpack_uuid()
+        entity.mob_type = buff.unpack_varint()
+        entity.x, entity.y, entity.z = buff.unpack('ddd')
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.head_pitch = b2f(buff.unpack('B'))
+        entity.dx, entity.dy, entity.dz = buff.unpack('hhh')
+        entity.metadata = read_metadata(buff, self.metadata_types)
+        self.add_entity(entity)
 
     def packet_downstream_spawn_object(self, buff):
-        entity = {'type': 'object'}
-        entity['id'] = buff.unpack_varint()
-        entity['uuid'] = buff.unpack_uuid()
-        entity['object_type'] = buff.unpack_varint()
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        entity['yaw'] = b2f(buff.unpack('B'))
-        entity['pitch'] = b2f(buff.unpack('B'))
-        entity['object_data'] = buff.unpack('i')
-        entity['dx'], entity['dy'], entity['dz'] = buff.unpack('hhh')
-        self.entities[entity['id']] = entity
+        entity = Entity('object', buff.unpack_varint())
+        entity.uuid = buff.unpack_uuid()
+        entity.object_type = buff.unpack_varint()
+        entity.x, entity.y, entity.z = buff.unpack('ddd')
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.object_data = buff.unpack('i')
+        entity.dx, entity.dy, entity.dz = buff.unpack('hhh')
+        self.add_entity(entity)
 
     def packet_downstream_spawn_painting(self, buff):
-        entity = {'type': 'painting'}
-        entity['id'] = buff.unpack_varint()
-        entity['uuid'] = buff.unpack_uuid()
-        entity['painting_type'] = buff.unpack_string()
-        entity['x'], entity['y'], entity['z'] = buff.unpack_position()
-        entity['painting_direction'] = buff.unpack('b')
-        self.entities[entity['id']] = entity
+        entity = Entity('painting', buff.unpack_varint())
+        entity.uuid = buff.unpack_uuid()
+        entity.painting_type = buff.unpack_string()
+        entity.x, entity.y, entity.z = buff.unpack_position()
+        entity.painting_direction = buff.unpack('b')
+        self.add_entity(entity)
 
     def packet_downstream_spawn_global_entity(self, buff):
-        entity = {'type': 'global_entity'}
-        entity['id'] = buff.unpack_varint()
-        entity['global_entity_type'] = buff.unpack('b')
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        self.entities[entity['id']] = entity
+        entity = Entity('global_entity', buff.unpack_varint())
+        entity.global_entity_type = buff.unpack('b')
+        entity.x, entity.y, entity.z = buff.unpack('ddd')
+        self.add_entity(entity)
 
     def packet_downstream_spawn_experience_orb(self, buff):
-        entity = {'type': 'experience_orb'}
-        entity['id'] = buff.unpack_varint()
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        entity['experience_count'] = buff.unpack('h')
-        self.entities[entity['id']] = entity
+        entity = Entity('experience_orb', buff.unpack_varint())
+        entity.x, entity.y, entity.z = buff.unpack('ddd')
+        entity.experience_count = buff.unpack('h')
+        self.add_entity(entity)
 
     def packet_downstream_destroy_entities(self, buff):
         for _ in range(buff.unpack_varint()):
-            del self.entities[buff.unpack_varint()]
+            self.remove_entity(buff.unpack_varint())
 
     # Entity position ---------------------------------------------------------
 
     def packet_downstream_entity_teleport(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['x'], entity['y'], entity['z'] = buff.unpack('ddd')
-        entity['yaw'] = b2f(buff.unpack('B'))
-        entity['pitch'] = b2f(buff.unpack('B'))
-        entity['on_ground'] = buff.unpack('?')
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        self.move_entity(entity, *buff.unpack('ddd'))
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.on_ground = buff.unpack('?')
 
     def packet_downstream_entity_look_and_relative_move(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['x'] += buff.unpack('h')
-        entity['y'] += buff.unpack('h')
-        entity['z'] += buff.unpack('h')
-        entity['yaw'] = b2f(buff.unpack('B'))
-        entity['pitch'] = b2f(buff.unpack('B'))
-        entity['on_ground'] = buff.unpack('?')
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        dx, dy, dz = buff.unpack('hhh')
+        self.move_entity(
+            entity,
+            entity.x + dx / 4096.0,
+            entity.y + dy / 4096.0,
+            entity.z + dz / 4096.0)
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.on_ground = buff.unpack('?')
 
     def packet_downstream_entity_look(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['yaw'] = b2f(buff.unpack('B'))
-        entity['pitch'] = b2f(buff.unpack('B'))
-        entity['on_ground'] = buff.unpack('?')
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        entity.yaw = b2f(buff.unpack('B'))
+        entity.pitch = b2f(buff.unpack('B'))
+        entity.on_ground = buff.unpack('?')
 
     def packet_downstream_entity_relative_move(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['x'] += buff.unpack('h')
-        entity['y'] += buff.unpack('h')
-        entity['z'] += buff.unpack('h')
-        entity['on_ground'] = buff.unpack('?')
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        dx, dy, dz = buff.unpack('hhh')
+        self.move_entity(
+            entity,
+            entity.x + dx / 4096.0,
+            entity.y + dy / 4096.0,
+            entity.z + dz / 4096.0)
+        entity.on_ground = buff.unpack('?')
 
     def packet_downstream_entity_velocity(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['dx'], entity['dy'], entity['dz'] = buff.unpack('hhh')
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        entity.dx, entity.dy, entity.dz = buff.unpack('hhh')
 
     def packet_downstream_entity_head_look(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['head_yaw'] = b2f(buff.unpack('B'))
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        entity.head_yaw = b2f(buff.unpack('B'))
 
     # Entity misc -------------------------------------------------------------
 
     def packet_downstream_entity_metadata(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        if 'metadata' not in entity:
-            entity['metadata'] = {}
-        for ty_key, val in buff.unpack_entity_metadata().items():
-            entity['metadata'][ty_key] = val
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        metadata = read_metadata(buff, self.metadata_types)
+        if entity.metadata is None:
+            entity.metadata = metadata
+        else:
+            entity.metadata.update(metadata)
+
+    def get_metadata(self, entity, index):
+        # Returns the decoded value of an entity's metadata entry, or None
+        entry = (entity.metadata or {}).get(index)
+        if entry is not None:
+            buff = self.bt(entry + b"\xff")
+            for value in buff.unpack_entity_metadata().values():
+                return value
+
+    def pack_metadata(self, entity):
+        return b"".join((entity.metadata or {}).values()) + b"\xff"
 
     def packet_downstream_entity_effect(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        if 'effects' not in entity:
-            entity['effects'] = {}
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        if entity.effects is None:
+            entity.effects = {}
         effect = {}
         effect['id'] = buff.unpack('b')
         effect['amplifier'] = buff.unpack('b')
         effect['duration'] = buff.unpack_varint()
         effect['flags'] = buff.unpack('b')
-        entity['effects'][effect['id']] = effect
+        entity.effects[effect['id']] = effect
 
     def packet_downstream_remove_entity_effect(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        del entity['effects'][buff.unpack('b')]
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        effect_id = buff.unpack('b')
+        if entity.effects:
+            entity.effects.pop(effect_id, None)
 
     def packet_downstream_entity_equipment(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        if 'equipment' not in entity:
-            entity['equipment'] = [{'item': None} for _ in range(6)]
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        if entity.equipment is None:
+            entity.equipment = [{'item': None} for _ in range(6)]
         idx = buff.unpack_varint()
-        entity['equipment'][idx] = buff.unpack_slot()
+        entity.equipment[idx] = buff.unpack_slot()
 
     def packet_downstream_set_passengers(self, buff):
-        entity = self.entities[buff.unpack_varint()]
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
         count = buff.unpack_varint()
-        entity['passengers'] = [buff.unpack_varint() for _ in range(count)]
+        entity.passengers = [buff.unpack_varint() for _ in range(count)]
 
-        if self.player['id'] in entity['passengers']:
-            self.player['vehicle'] = entity['id']
-        elif self.player.get('vehicle') == entity['id']:
-            self.player['vehicle'] = None
+        if self.player.id in entity.passengers:
+            self.player.vehicle = entity.id
+        elif self.player.vehicle == entity.id:
+            self.player.vehicle = None
+            self.wake_updates()
 
     def packet_downstream_attach_entity(self, buff):
-        entity = self.entities[buff.unpack('i')]
+        entity = self.get_entity(buff.unpack('i'), buff)
+        if entity is None:
+            return
         other = buff.unpack('i')
         if other == -1:
-            entity['attached'] = None
+            entity.attached = None
         else:
-            entity['attached'] = other
+            entity.attached = other
 
     def packet_downstream_entity_properties(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        if 'properties' not in entity:
-            entity['properties'] = {}
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        if entity.properties is None:
+            entity.properties = {}
         for _ in range(buff.unpack('i')):
             property = {}
             property['key'] = buff.unpack_string()
@@ -385,31 +601,36 @@ class EntitiesPlugin(Plugin):
                 modifier['amount'] = buff.unpack('d')
                 modifier['operation'] = buff.unpack('b')
                 property['modifiers'].append(modifier)
-            entity['properties'][property['key']] = property
+            entity.properties[property['key']] = property
 
     def packet_downstream_use_bed(self, buff):
-        entity = self.entities[buff.unpack_varint()]
-        entity['bed'] = buff.unpack_position()
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
+        entity.bed = buff.unpack_position()
 
     def packet_downstream_animation(self, buff):
-        entity = self.entities[buff.unpack_varint()]
+        entity = self.get_entity(buff.unpack_varint(), buff)
+        if entity is None:
+            return
         animation = buff.unpack('b')
         if animation == 2:
-            entity['bed'] = None
+            entity.bed = None
 
     # Player position ---------------------------------------------------------
 
     # TODO: forwarding
     def packet_downstream_player_position_and_look(self, buff):
-        pos_look = buff.unpack('dddff')
+        pos_look = list(buff.unpack('dddff'))
         flags = buff.unpack('B')
         keys = ("x", "y", "z", "yaw", "pitch")
 
         for idx, key in enumerate(keys):
             if flags & (1 << idx):
-                self.player[key] += pos_look[idx]
-            else:
-                self.player[key] = pos_look[idx]
+                pos_look[idx] += getattr(self.player, key)
+
+        self.move_player(*pos_look[:3])
+        self.player.yaw, self.player.pitch = pos_look[3:]
 
         teleport_id = buff.unpack_varint()
 
@@ -419,31 +640,27 @@ class EntitiesPlugin(Plugin):
                 self.bt.pack_varint(teleport_id))
 
         if not self.spawned:
-            self.ticker.add_loop(1, self.update_player_inc)
-            self.ticker.add_loop(20, self.update_player_full)
+            self.ticker.add_loop(1, self.update_player)
             self.spawned = True
+        self.wake_updates()
 
     def packet_upstream_player(self, buff):
-        self.player['on_ground'] = buff.unpack('?')
+        self.player.on_ground = buff.unpack('?')
 
     def packet_upstream_player_position(self, buff):
-        self.player['x'] = buff.unpack('d')
-        self.player['y'] = buff.unpack('d')
-        self.player['z'] = buff.unpack('d')
-        self.player['on_ground'] = buff.unpack('?')
+        self.move_player(*buff.unpack('ddd'))
+        self.player.on_ground = buff.unpack('?')
 
     def packet_upstream_player_look(self, buff):
-        self.player['yaw'] = buff.unpack('f')
-        self.player['pitch'] = buff.unpack('f')
-        self.player['on_ground'] = buff.unpack('?')
+        self.player.yaw = buff.unpack('f')
+        self.player.pitch = buff.unpack('f')
+        self.player.on_ground = buff.unpack('?')
 
     def packet_upstream_player_position_and_look(self, buff):
-        self.player['x'] = buff.unpack('d')
-        self.player['y'] = buff.unpack('d')
-        self.player['z'] = buff.unpack('d')
-        self.player['yaw'] = buff.unpack('f')
-        self.player['pitch'] = buff.unpack('f')
-        self.player['on_ground'] = buff.unpack('?')
+        self.move_player(*buff.unpack('ddd'))
+        self.player.yaw = buff.unpack('f')
+        self.player.pitch = buff.unpack('f')
+        self.player.on_ground = buff.unpack('?')
 
     # Player action -----------------------------------------------------------
 
@@ -452,77 +669,96 @@ class EntitiesPlugin(Plugin):
         action = buff.unpack_varint()
         jump_boost = buff.unpack_varint()
 
-        if   action == 0: self.player['actions']['sneaking'] = True
-        elif action == 1: self.player['actions']['sneaking'] = False
-        elif action == 2: self.player['bed'] = None
-        elif action == 3: self.player['actions']['sprinting'] = True
-        elif action == 4: self.player['actions']['sprinting'] = False
-        elif action == 5: self.player['actions']['horse_jumping'] = True
-        elif action == 6: self.player['actions']['horse_jumping'] = False
+        if   action == 0: self.player.actions['sneaking'] = True
+        elif action == 1: self.player.actions['sneaking'] = False
+        elif action == 2: self.player.bed = None
+        elif action == 3: self.player.actions['sprinting'] = True
+        elif action == 4: self.player.actions['sprinting'] = False
+        elif action == 5: self.player.actions['horse_jumping'] = True
+        elif action == 6: self.player.actions['horse_jumping'] = False
         elif action == 7: pass  # TODO: horse inventory
         elif action == 8: pass  # TODO: elytra
 
     # Player vehicle ----------------------------------------------------------
 
     def packet_downstream_vehicle_move(self, buff):
-        vehicle = self.entities[self.player['vehicle']]
-
-        self.player['x'] = vehicle['x'] = buff.unpack('d')
-        self.player['y'] = vehicle['y'] = buff.unpack('d')
-        self.player['z'] = vehicle['z'] = buff.unpack('d')
-        self.player['yaw'] = vehicle['yaw'] = buff.unpack('f')
-        self.player['pitch'] = vehicle['pitch'] = buff.unpack('f')
+        self.move_vehicle(buff)
 
     def packet_upstream_vehicle_move(self, buff):
-        vehicle = self.entities[self.player['vehicle']]
+        self.move_vehicle(buff)
+
+    def move_vehicle(self, buff):
+        x, y, z, yaw, pitch = buff.unpack('dddff')
+        self.move_player(x, y, z)
+        self.player.yaw, self.player.pitch = yaw, pitch
 
-        self.player['x'] = vehicle['x'] = buff.unpack('d')
-        self.player['y'] = vehicle['y'] = buff.unpack('d')
-        self.player['z'] = vehicle['z'] = buff.unpack('d')
-        self.player['yaw'] = vehicle['yaw'] = buff.unpack('f')
-        self.player['pitch'] = vehicle['pitch'] = buff.unpack('f')
+        vehicle = self.entities.get(self.player.vehicle)
+        if vehicle is not None:
+            self.move_entity(vehicle, x, y, z)
+            vehicle.yaw, vehicle.pitch = yaw, pitch
 
     # Player tasks ------------------------------------------------------------
 
-    def update_player_inc(self):
-        vehicle = self.player.get('vehicle')
-        if vehicle:
-            self.upstream.send_packet(
-                "player_look",
-                self.bt.pack(
-                    'ff?',
-                    self.player['yaw'],
-                    self.player['pitch'],
-                    self.player['on_ground']))
-            self.upstream.send_packet(
-                "steer_vehicle",
-                self.bt.pack('ffb', 0, 0, 0))
-            self.upstream.send_packet(
-                "vehicle_move",
-                self.bt.pack(
-                    'dddff',
-                    self.player['x'],
-                    self.player['y'],
-                    self.player['z'],
-                    self.player['yaw'],
-                    self.player['pitch']))
+    # While detached, the player's movement is sent at full rate when riding
+    # a vehicle. Otherwise updates are sent every tick for a second after a
+    # teleport, respawn or dismount, then back off to one every
+    # idle_update_interval ticks. A full position is sent only if the player
+    # has moved since the last update.
+
+    def wake_updates(self):
+        self.update_interval = 1
+        self.update_ticks = 0
+        self.wake_remaining = self.wake_ticks
+        self.player_moved = True
+
+    def update_player(self):
+        if self.player.vehicle:
+            return self.update_vehicle()
+
+        self.update_ticks += 1
+        if self.update_ticks < self.update_interval:
+            return
+        self.update_ticks = 0
+        if self.wake_remaining:
+            self.wake_remaining -= 1
         else:
-            self.upstream.send_packet(
-                "player",
-                self.bt.pack('?', self.player['on_ground']))
+            self.update_interval = min(
+                2 * self.update_interval, idle_update_interval)
 
-    def update_player_full(self):
-        vehicle = self.player.get('vehicle')
-        if vehicle:
-            pass
-        else:
+        if self.player_moved:
+            self.player_moved = False
             self.upstream.send_packet(
                 "player_position_and_look",
                 self.bt.pack(
                     'dddff?',
-                    self.player['x'],
-                    self.player['y'],
-                    self.player['z'],
-                    self.player['yaw'],
-                    self.player['pitch'],
-                    self.player['on_ground']))
+                    self.player.x,
+                    self.player.y,
+                    self.player.z,
+                    self.player.yaw,
+                    self.player.pitch,
+                    self.player.on_ground))
+        else:
+            self.upstream.send_packet(
+                "player",
+                self.bt.pack('?', self.player.on_ground))
+
+    def update_vehicle(self):
+        self.upstream.send_packet(
+            "player_look",
+            self.bt.pack(
+                'ff?',
+                self.player.yaw,
+                self.player.pitch,
+                self.player.on_ground))
+        self.upstream.send_packet(
+            "steer_vehicle",
+            self.bt.pack('ffb', 0, 0, 0))
+        self.upstream.send_packet(
+            "vehicle_move",
+            self.bt.pack(
+                'dddff',
+                self.player.x,
+                self.player.y,
+                self.player.z,
+                self.player.yaw,
+                self.player.pitch))
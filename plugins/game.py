@@ -15,6 +15,11 @@ class GamePlugin(Plugin):
         self.tags = {}
         self.recipes = []
         self.commands = {}
+        self.tags_packet = self.add_prepared('tags', self.pack_tags)
+        self.recipes_packet = self.add_prepared(
+            'declare_recipes', self.pack_recipes)
+        self.commands_packet = self.add_prepared(
+            'declare_commands', self.pack_commands)
 
     def attach(self):
         self.downstream.send_packet(
@@ -38,6 +43,15 @@ class GamePlugin(Plugin):
                 'change_game_state',
                 self.bt.pack('bf', 2, 0))
 
+        # Servers before 1.13 send no tags, recipes or commands
+        if self.tags:
+            self.tags_packet.send()
+        if self.recipes:
+            self.recipes_packet.send()
+        if self.commands:
+            self.commands_packet.send()
+
+    def pack_tags(self):
         data = b""
         for kind in ('block', 'item', 'fluid'):
             data += self.bt.pack_varint(len(self.tags[kind]))
@@ -46,16 +60,16 @@ class GamePlugin(Plugin):
                 data += self.bt.pack_varint(len(values))
                 for value in values:
                     data += self.bt.pack_varint(value)
-        self.downstream.send_packet('tags', data)
+        return data
 
+    def pack_recipes(self):
         data = self.bt.pack_varint(len(self.recipes))
         for recipe in self.recipes:
             data += self.bt.pack_recipe(**recipe)
-        self.downstream.send_packet('declare_recipes', data)
+        return data
 
-        self.downstream.send_packet(
-            'declare_commands',
-            self.bt.pack_commands(self.commands))
+    def pack_commands(self):
+        return self.bt.pack_commands(self.commands)
 
     def packet_downstream_join_game(self, buff):
         self.player_id = buff.unpack('i')
@@ -100,11 +114,14 @@ class GamePlugin(Plugin):
                 self.tags[kind][tag] = []
                 for __ in range(buff.unpack_varint()):
                     self.tags[kind][tag].append(buff.unpack_varint())
+        self.tags_packet.invalidate()
 
     def packet_downstream_declare_recipes(self, buff):
         self.recipes = []
         for _ in range(buff.unpack_varint()):
             self.recipes.append(buff.unpack_recipe())
+        self.recipes_packet.invalidate()
 
     def packet_downstream_declare_commands(self, buff):
         self.commands = buff.unpack_commands()
+        self.commands_packet.invalidate()
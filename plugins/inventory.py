@@ -3,7 +3,7 @@ from plugins import Plugin
 
 class InventoryPlugin(Plugin):
     def setup(self):
-        self.inventory = [{'id': -1} for _ in range(46)]
+        self.inventory = [{'item': None} for _ in range(46)]
         self.held_item = 0
         self.recipes = set()
 
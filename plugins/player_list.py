@@ -5,6 +5,8 @@ class PlayerListPlugin(Plugin):
     def setup(self):
         self.players = {}
         self.players_header_footer = None
+        self.players_packet = self.add_prepared(
+            'player_list_item', self.pack_players)
 
     def attach(self):
         # Send 'Player List Header and Footer'
@@ -15,6 +17,9 @@ class PlayerListPlugin(Plugin):
                 self.bt.pack_chat(self.players_header_footer[1]))
 
         # Send 'Player List Item'
+        self.players_packet.send()
+
+    def pack_players(self):
         data = b""
         for player in self.players.values():
             data += self.bt.pack_uuid(player['uuid'])
@@ -30,13 +35,11 @@ class PlayerListPlugin(Plugin):
             data += self.bt.pack_optional(
                 self.bt.pack_chat, player['display_name'])
 
-        self.downstream.send_packet(
-            'player_list_item',
-            self.bt.pack_varint(0),
-            self.bt.pack_varint(len(self.players)),
-            data)
+        return self.bt.pack_varint(0) + \
+            self.bt.pack_varint(len(self.players)) + data
 
     def packet_downstream_player_list_item(self, buff):
+        self.players_packet.invalidate()
         action = buff.unpack_varint()
         for _ in range(buff.unpack_varint()):
             uuid = buff.unpack_uuid()
@@ -1,18 +1,12 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache
 
 
 class ResourcePackPlugin(Plugin):
     def setup(self):
-        self.url = None
-        self.hash = None
+        self.resource_pack = PacketCache('resource_pack_send')
 
     def attach(self):
-        if self.url:
-            self.downstream.send_packet(
-                'resource_pack_send',
-                self.bt.pack_string(self.url),
-                self.bt.pack_string(self.hash))
+        self.resource_pack.send(self.downstream)
 
     def packet_downstream_resource_pack_send(self, buff):
-        self.url = buff.unpack_string()
-        self.hash = buff.unpack_string()
+        self.resource_pack.set(None, buff.read())
@@ -1,34 +1,17 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache
 
 
 class StatsPlugin(Plugin):
     def setup(self):
-        self.health = 0
-        self.food = 0
-        self.food_saturation = 0
-        self.experience_bar = 0
-        self.experience_level = 0
-        self.experience_total = 0
+        self.health = PacketCache('update_health')
+        self.experience = PacketCache('set_experience')
 
     def attach(self):
-        self.downstream.send_packet(
-            'update_health',
-            self.bt.pack('f', self.health),
-            self.bt.pack_varint(self.food),
-            self.bt.pack('f', self.food_saturation))
-
-        self.downstream.send_packet(
-            'set_experience',
-            self.bt.pack('f', self.experience_bar),
-            self.bt.pack_varint(self.experience_level),
-            self.bt.pack_varint(self.experience_total))
+        self.health.send(self.downstream)
+        self.experience.send(self.downstream)
 
     def packet_downstream_update_health(self, buff):
-        self.health = buff.unpack('f')
-        self.food = buff.unpack_varint()
-        self.food_saturation = buff.unpack('f')
+        self.health.set(None, buff.read())
 
     def packet_downstream_set_experience(self, buff):
-        self.experience_bar = buff.unpack('f')
-        self.experience_level = buff.unpack_varint()
-        self.experience_total = buff.unpack_varint()
+        self.experience.set(None, buff.read())
@@ -1,17 +1,12 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache
 
 
 class TimePlugin(Plugin):
     def setup(self):
-        self.time_world = 0
-        self.time_day = 0
+        self.time = PacketCache('time_update')
 
     def attach(self):
-        self.downstream.send_packet(
-            'time_update',
-            self.bt.pack('q', self.time_world),
-            self.bt.pack('q', self.time_day))
+        self.time.send(self.downstream)
 
     def packet_downstream_time_update(self, buff):
-        self.time_world = buff.unpack('q')
-        self.time_day = buff.unpack('q')
+        self.time.set(None, buff.read())
@@ -1,11 +1,367 @@
-from quarry.types.chunk import BlockArray, LightArray
+import collections
+import collections.abc
+import mmap
+import tempfile
+import time
+
+import numpy
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from config import chunk_cache_limit, chunk_cache_path, \
+    chunk_retention_radius, chunk_encode_threads
 from plugins import Plugin
+from plugins.entities import EntitiesPlugin
+
+
+def unpack_blocks(data, bits, palette):
+    # Block indices are packed into big-endian longs, least significant bit
+    # first, and may span two longs. Reversing each long's bytes gives one
+    # little-endian bit stream.
+    stream = numpy.frombuffer(data, numpy.uint8).reshape(-1, 8)[:, ::-1]
+    stream = numpy.unpackbits(stream, bitorder='little')
+    indices = stream[:4096 * bits].reshape(4096, bits).dot(
+        1 << numpy.arange(bits))
+    if palette:
+        return numpy.array(palette, numpy.uint16)[indices]
+    else:
+        return indices.astype(numpy.uint16)
+
+
+def pack_blocks(blocks, max_bits):
+    # Returns a (bits, palette, data) tuple
+    palette, indices = numpy.unique(blocks, return_inverse=True)
+    bits = max(4, int(len(palette) - 1).bit_length())
+    if bits > 8:
+        bits = max_bits
+        palette = []
+        indices = blocks
+    else:
+        palette = palette.tolist()
+    stream = (indices.reshape(4096, 1) >> numpy.arange(bits)) & 1
+    stream = numpy.packbits(stream.astype(numpy.uint8), bitorder='little')
+    return bits, palette, stream.reshape(-1, 8)[:, ::-1].tobytes()
+
+
+def get_chunk_size(chunk):
+    # Returns a rough estimate of a chunk's memory use, in bytes
+    size = 1024 + len(chunk['packet'] or b"") + len(chunk['frame'] or b"")
+    if chunk['sections'] is not None:
+        for section in chunk['sections']:
+            if isinstance(section, bytes):
+                size += len(section)
+            elif section:
+                size += section[0].nbytes + len(section[1])
+        size += len(chunk['biomes'])
+        if isinstance(chunk['block_entities'], bytes):
+            size += len(chunk['block_entities'])
+        else:
+            size += 1024 * len(chunk['block_entities'])
+    return size
+
+
+pool = None
+
+
+def get_pool():
+    # Returns the pool of chunk encoding threads shared by all sessions, or
+    # None if chunks are encoded on the reactor thread
+    global pool
+    if pool is None and chunk_encode_threads:
+        pool = ThreadPool(0, chunk_encode_threads, "chunk-encoder")
+        pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+    return pool
+
+
+class ChunkCache(collections.abc.MutableMapping):
+    # Holds chunks in memory up to a limit in bytes. The least recently used
+    # chunks are evicted to an anonymous region file, and are read back via
+    # mmap when next accessed.
+
+    def __init__(self, dump, load, limit, path=None):
+        self.dump = dump
+        self.load = load
+        self.limit = limit
+        self.path = path
+        self.memory = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.touched = set()
+        self.index = {}
+        self.region = None
+        self.region_map = None
+        self.region_size = 0
+        self.region_garbage = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.memory) + len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.memory) + list(self.index))
+
+    def __contains__(self, coords):
+        return coords in self.memory or coords in self.index
+
+    def __getitem__(self, coords):
+        chunk = self.memory.get(coords)
+        if chunk is not None:
+            self.hits += 1
+            self.memory.move_to_end(coords)
+        else:
+            chunk = self.read(coords)
+            self.forget(coords)
+            self.memory[coords] = chunk
+            self.trim()
+        self.touched.add(coords)
+        return chunk
+
+    def __setitem__(self, coords, chunk):
+        if coords in self.index:
+            self.forget(coords)
+        self.memory[coords] = chunk
+        self.memory.move_to_end(coords)
+        self.trim()
+        self.touched.add(coords)
+
+    def __delitem__(self, coords):
+        if coords in self.memory:
+            del self.memory[coords]
+            self.size -= self.sizes.pop(coords, 0)
+            self.touched.discard(coords)
+        else:
+            self.forget(coords)
+
+    def peek(self, coords):
+        # Returns a chunk without paging it in or changing its recency
+        chunk = self.memory.get(coords)
+        if chunk is None:
+            chunk = self.read(coords)
+        return chunk
+
+    def resident(self, coords):
+        # Returns a chunk if it is in memory, without changing its recency
+        chunk = self.memory.get(coords)
+        if chunk is not None:
+            self.touched.add(coords)
+        return chunk
+
+    def page_out(self, coords):
+        # Moves a chunk in memory to the region file, returning whether it did
+        chunk = self.memory.pop(coords, None)
+        if chunk is None:
+            return False
+        self.size -= self.sizes.pop(coords, 0)
+        self.touched.discard(coords)
+        self.write(coords, self.dump(coords, chunk))
+        return True
+
+    def trim(self):
+        for coords in self.touched:
+            if coords in self.memory:
+                size = get_chunk_size(self.memory[coords])
+                self.size += size - self.sizes.get(coords, 0)
+                self.sizes[coords] = size
+        self.touched.clear()
+
+        while self.size > self.limit and len(self.memory) > 1:
+            coords, chunk = self.memory.popitem(last=False)
+            self.size -= self.sizes.pop(coords, 0)
+            self.write(coords, self.dump(coords, chunk))
+            self.evictions += 1
+
+    # Region file -------------------------------------------------------------
+
+    def read(self, coords):
+        offset, length = self.index[coords]
+        self.misses += 1
+        if self.region_map is None:
+            self.region.flush()
+            self.region_map = mmap.mmap(
+                self.region.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.load(self.region_map[offset:offset + length])
+
+    def write(self, coords, data):
+        if self.region is None:
+            self.region = tempfile.TemporaryFile(dir=self.path)
+        self.region.seek(self.region_size)
+        self.region.write(data)
+        self.index[coords] = (self.region_size, len(data))
+        self.region_size += len(data)
+        self.unmap()
+
+    def forget(self, coords):
+        offset, length = self.index.pop(coords)
+        self.region_garbage += length
+        if self.region_garbage > max(self.region_size // 2, 1 << 24):
+            self.compact()
+
+    def compact(self):
+        # Rewrites the region file without the space used by forgotten chunks
+        region = tempfile.TemporaryFile(dir=self.path)
+        self.region.flush()
+        index = {}
+        for coords, (offset, length) in self.index.items():
+            self.region.seek(offset)
+            index[coords] = (region.tell(), length)
+            region.write(self.region.read(length))
+        self.unmap()
+        self.region.close()
+        self.region = region
+        self.region_size = region.tell()
+        self.region_garbage = 0
+        self.index = index
+
+    def unmap(self):
+        if self.region_map is not None:
+            self.region_map.close()
+            self.region_map = None
+
+    def describe(self):
+        return (
+            "chunks: %d in memory (%.1f MB), %d on disk (%.1f MB); "
+            "hits: %d, misses: %d, evictions: %d" % (
+                len(self.memory), self.size / 1048576.0,
+                len(self.index), self.region_size / 1048576.0,
+                self.hits, self.misses, self.evictions))
+
+
+class ChunkReplay(object):
+    # The progress of replaying the world to one client
+
+    def __init__(self, downstream, order):
+        self.downstream = downstream
+        self.queue = collections.OrderedDict.fromkeys(order)
+        self.count = len(self.queue)
+        self.start = time.perf_counter()
+        self.slices = 0
+        self.call = None
+        self.encoding = {}
 
 
 class WorldPlugin(Plugin):
+    replay_slice = 16
+    prepare_slice = 4
+
     def setup(self):
-        self.chunks = {}
+        self.chunks = ChunkCache(
+            self.dump_chunk,
+            self.load_chunk,
+            chunk_cache_limit * 1048576,
+            chunk_cache_path)
         self.dimension = 0
+        self.replays = {}
+        self.unprepared = collections.OrderedDict()
+        self.frame_threshold = None
+        self.centre = None
+        self.culled = 0
+
+        self.pool = get_pool()
+
+    def describe(self):
+        return "%s; culled: %d" % (self.chunks.describe(), self.culled)
+
+    # Chunks are saved over a hot restart in their region file form, least
+    # recently used first, so the cache is rebuilt in the same order.
+
+    def get_state(self):
+        order = list(self.chunks.index) + list(self.chunks.memory)
+        return {
+            'dimension': self.dimension,
+            'centre': self.centre,
+            'culled': self.culled,
+            'chunks': [(coords, self.dump_chunk(
+                coords, self.chunks.peek(coords))) for coords in order]}
+
+    def set_state(self, state):
+        self.dimension = state['dimension']
+        self.centre = state['centre']
+        self.culled = state['culled']
+        now = time.monotonic()
+        for coords, data in state['chunks']:
+            self.chunks[coords] = self.load_chunk(data)
+            self.unprepared[coords] = now
+
+    # Chunks are stored as an encoded 'Chunk Data' payload until something
+    # needs their contents. The payload is kept as a cache until the chunk
+    # is modified. Each section is None (empty), bytes (not yet decoded), or a
+    # decoded (blocks, lights) tuple, where blocks is an array of 4096 global
+    # block IDs in YZX order, and lights is the raw light data.
+
+    def get_sections(self, chunk):
+        if chunk['sections'] is None:
+            buff = self.bt(chunk['packet'])
+            buff.unpack('ii?')
+            bitmask = buff.unpack_varint()
+            data = buff.read(buff.unpack_varint())
+            chunk['sections'], chunk['biomes'] = self.split_sections(
+                data, bitmask, chunk['overworld'])
+            chunk['block_entities'] = buff.read()
+        return chunk['sections']
+
+    def get_section(self, chunk, idx, create=False):
+        sections = self.get_sections(chunk)
+        section = sections[idx]
+        if isinstance(section, bytes):
+            section = sections[idx] = self.unpack_section(section)
+        elif section is None and create:
+            section = sections[idx] = (
+                numpy.zeros(4096, numpy.uint16),
+                bytes(4096 if chunk['overworld'] else 2048))
+        return section
+
+    def unpack_section(self, data):
+        buff = self.bt(data)
+        bits = buff.unpack('B')
+        palette = buff.unpack_chunk_section_palette(bits)
+        blocks = unpack_blocks(
+            buff.read(8 * buff.unpack_varint()), bits, palette)
+        return blocks, buff.read()
+
+    def pack_section(self, section):
+        blocks, lights = section
+        bits, palette, data = pack_blocks(blocks, self.bt.registry.max_bits)
+        return b"".join((
+            self.bt.pack('B', bits),
+            self.bt.pack_chunk_section_palette(palette),
+            self.bt.pack_varint(len(data) // 8),
+            data,
+            lights))
+
+    def split_sections(self, data, bitmask, overworld):
+        # Returns a list of raw sections, and any remaining biome data
+        buff = self.bt(data)
+        sections = [None] * 16
+        for idx in range(16):
+            if bitmask & (1 << idx):
+                start = len(data) - len(buff)
+                buff.unpack_chunk_section_palette(buff.unpack('B'))
+                buff.read(8 * buff.unpack_varint())
+                buff.read(4096 if overworld else 2048)
+                sections[idx] = data[start:len(data) - len(buff)]
+        return sections, buff.read()
+
+    def get_block_entities(self, chunk):
+        self.get_sections(chunk)
+        if isinstance(chunk['block_entities'], bytes):
+            chunk['block_entities'] = self.unpack_block_entities(
+                chunk['block_entities'])
+        return chunk['block_entities']
+
+    def unpack_block_entities(self, data):
+        buff = self.bt(data)
+        block_entities = {}
+        for _ in range(buff.unpack_varint()):
+            block_entity = buff.unpack_nbt()
+            block_entity_obj = block_entity.to_obj()[""]
+            block_entities[
+                block_entity_obj['x'],
+                block_entity_obj['y'],
+                block_entity_obj['z']] = block_entity
+        return block_entities
 
     def set_block(self, x, y, z, block_id):
         cx, bx = divmod(x, 16)
@@ -13,127 +369,479 @@ class WorldPlugin(Plugin):
         cz, bz = divmod(z, 16)
 
         chunk = self.chunks.get((cx, cz))
-        if chunk:
-            chunk['sections'][cy][0][by*256 + bz*16 + bx] = block_id
+        if chunk and 0 <= cy < 16:
+            section = self.get_section(chunk, cy, create=True)
+            section[0][by*256 + bz*16 + bx] = block_id
+            self.dirty_chunk((cx, cz), chunk)
 
         # TODO: adjust lighting
 
+    def set_blocks(self, xs, ys, zs, block_ids):
+        # Sets many blocks at once, with one scatter per section touched
+        xs, ys, zs = (numpy.asarray(v, numpy.int64) for v in (xs, ys, zs))
+        block_ids = numpy.broadcast_to(
+            numpy.asarray(block_ids, numpy.uint16), xs.shape)
+        indices = (ys & 15) * 256 + (zs & 15) * 16 + (xs & 15)
+        keys, inverse = numpy.unique(
+            numpy.stack((xs >> 4, ys >> 4, zs >> 4), axis=1),
+            axis=0,
+            return_inverse=True)
+        inverse = inverse.ravel()
+
+        for n, (cx, cy, cz) in enumerate(keys.tolist()):
+            chunk = self.chunks.get((cx, cz))
+            if chunk and 0 <= cy < 16:
+                mask = inverse == n
+                section = self.get_section(chunk, cy, create=True)
+                section[0][indices[mask]] = block_ids[mask]
+                self.dirty_chunk((cx, cz), chunk)
+
     def get_block(self, x, y, z):
-        cx, bx = divmod(x, 16)
+        chunk = self.chunks.get((x // 16, z // 16))
+        if chunk:
+            return self.get_chunk_block(chunk, x, y, z)
+        return 0
+
+    def get_chunk_block(self, chunk, x, y, z):
         cy, by = divmod(y, 16)
-        cz, bz = divmod(z, 16)
+        if 0 <= cy < 16:
+            section = self.get_section(chunk, cy)
+            if section:
+                return int(section[0][by*256 + (z % 16)*16 + (x % 16)])
+        return 0
 
-        chunk = self.chunks.get((cx, cz))
-        if chunk:
-            return chunk['sections'][cy][0][by*256 + bz*16 + bx]
-        else:
-            return 0
+    def get_region(self, x0, y0, z0, x1, y1, z1):
+        # Returns an array of block IDs in YZX order. The upper bounds are
+        # exclusive. Blocks in missing chunks or sections are zero.
+        region = numpy.zeros((y1 - y0, z1 - z0, x1 - x0), numpy.uint16)
+
+        def clip(lower, upper, c):
+            # Returns source and destination slices along one axis
+            lo, hi = max(lower, 16 * c), min(upper, 16 * c + 16)
+            return (slice(lo - 16 * c, hi - 16 * c),
+                    slice(lo - lower, hi - lower))
+
+        for cx in range(x0 >> 4, ((x1 - 1) >> 4) + 1):
+            src_x, dst_x = clip(x0, x1, cx)
+            for cz in range(z0 >> 4, ((z1 - 1) >> 4) + 1):
+                src_z, dst_z = clip(z0, z1, cz)
+                chunk = self.chunks.get((cx, cz))
+                if not chunk:
+                    continue
+                for cy in range(max(y0 >> 4, 0), min((y1 - 1) >> 4, 15) + 1):
+                    src_y, dst_y = clip(y0, y1, cy)
+                    section = self.get_section(chunk, cy)
+                    if section:
+                        region[dst_y, dst_z, dst_x] = section[0].reshape(
+                            16, 16, 16)[src_y, src_z, src_x]
+        return region
+
+    def get_chunk_packet(self, x, z, chunk):
+        if chunk['packet'] is None:
+            chunk['packet'] = self.pack_chunk(x, z, chunk)
+        return chunk['packet']
+
+    def pack_chunk(self, x, z, chunk):
+        bitmask = 0
+        data = []
+        for idx, section in enumerate(chunk['sections']):
+            if isinstance(section, tuple):
+                if not section[0].any():
+                    continue
+                section = self.pack_section(section)
+            if section:
+                bitmask |= 1 << idx
+                data.append(section)
+        data.append(chunk['biomes'])
+        data = b"".join(data)
+
+        return b"".join((
+            self.bt.pack('ii?', x, z, True),
+            self.bt.pack_varint(bitmask),
+            self.bt.pack_varint(len(data)),
+            data,
+            self.pack_block_entities(chunk['block_entities'])))
+
+    def pack_block_entities(self, block_entities):
+        if isinstance(block_entities, dict):
+            block_entities = self.bt.pack_varint(len(block_entities)) + \
+                b"".join(self.bt.pack_nbt(block_entity)
+                         for block_entity in block_entities.values())
+        return block_entities
+
+    def dirty_chunk(self, coords, chunk):
+        # Drops the cached payload, and marks any encoding in flight stale
+        chunk['packet'] = None
+        chunk['frame'] = None
+        self.unprepared.setdefault(coords, time.monotonic())
+        for replay in self.replays.values():
+            if coords in replay.encoding:
+                replay.encoding[coords] = False
+
+    # While detached, chunks in memory are packed and compressed into ready
+    # 'Chunk Data' frames a few at a time, in the order they changed.
+
+    def prepare(self):
+        self.frame_threshold = self.upstream.compression_threshold
+        for _ in range(min(self.prepare_slice, len(self.unprepared))):
+            coords, _ = self.unprepared.popitem(last=False)
+            chunk = self.chunks.resident(coords)
+            if chunk is not None:
+                x, z = coords
+                packet = self.get_chunk_packet(x, z, chunk)
+                if self.frame_threshold >= 0:
+                    chunk['frame'] = self.pack_frame(
+                        'chunk_data', packet, self.frame_threshold)
+
+    def get_staleness(self):
+        for changed in self.unprepared.values():
+            return len(self.unprepared), changed
+        return 0, None
+
+    def get_frame(self, downstream, chunk):
+        # Returns the chunk's prepared frame, if it suits the downstream
+        if self.frame_threshold == downstream.compression_threshold:
+            return chunk['frame']
+
+    def new_chunk(self, packet, overworld, block_actions=None):
+        return {
+            'packet': packet,
+            'overworld': overworld,
+            'sections': None,
+            'biomes': None,
+            'block_entities': None,
+            'block_actions': block_actions or {},
+            'frame': None}
+
+    def dump_chunk(self, coords, chunk):
+        x, z = coords
+        block_actions = chunk['block_actions']
+        return b"".join(
+            [self.bt.pack('?H', chunk['overworld'], len(block_actions))] +
+            [self.bt.pack('iiiiBB', bx, by, bz, *action)
+             for (bx, by, bz), action in block_actions.items()] +
+            [self.get_chunk_packet(x, z, chunk)])
+
+    def load_chunk(self, data):
+        buff = self.bt(data)
+        overworld, count = buff.unpack('?H')
+        block_actions = {}
+        for _ in range(count):
+            x, y, z, block_id, action_id, action_value = buff.unpack('iiiiBB')
+            block_actions[x, y, z] = (block_id, action_id, action_value)
+        return self.new_chunk(buff.read(), overworld, block_actions)
+
+    # Chunks are replayed to each client nearest-first from the player, a
+    # slice per reactor iteration, so the client can render its surroundings
+    # early. Chunks that are sent or unloaded by the server meanwhile are
+    # dropped.
 
     def attach(self):
-        for coords, chunk in self.chunks.items():
-            x, z = coords
-
-            bitmask = 0
-            data = b""
-            for i, section in enumerate(chunk['sections']):
-                if not section[0].is_empty():
-                    bitmask |= 1 << i
-                    data += self.bt.pack_chunk_section(*section)
-            data += self.bt.pack('I'*256, *chunk['biomes'])
-
-            self.downstream.send_packet(
+        player_x, player_z = self.get_centre()
+
+        def distance(coords):
+            dx, dz = coords[0] - player_x, coords[1] - player_z
+            return max(abs(dx), abs(dz)), dx * dx + dz * dz
+
+        replay = ChunkReplay(
+            self.downstream, sorted(self.chunks, key=distance))
+        self.replays[self.downstream] = replay
+        self.schedule_replay(replay)
+
+    def schedule_replay(self, replay):
+        replay.call = reactor.callLater(
+            0, self.upstream.session.charge, self.continue_replay, replay)
+
+    def remove_downstream(self, downstream):
+        replay = self.replays.pop(downstream, None)
+        if replay is not None and replay.call is not None and \
+                replay.call.active():
+            replay.call.cancel()
+
+    def detach(self):
+        for downstream in list(self.replays):
+            self.remove_downstream(downstream)
+
+    def skip_replay(self, coords):
+        for replay in self.replays.values():
+            replay.queue.pop(coords, None)
+            replay.encoding.pop(coords, None)
+
+    def continue_replay(self, replay):
+        replay.call = None
+        if self.replays.get(replay.downstream) is not replay:
+            return
+        if self.pool is not None:
+            return self.encode_slice(replay)
+        replay.downstream.begin_burst()
+        try:
+            more = self.replay_chunks(replay)
+        finally:
+            replay.downstream.end_burst()
+        if more:
+            self.schedule_replay(replay)
+
+    def replay_chunks(self, replay):
+        # Sends a slice of chunks, and returns True if more remain
+        for coords in self.take_slice(replay):
+            # Evicted chunks are read from disk without paging them in
+            chunk = self.chunks.peek(coords)
+            self.send_chunk(replay.downstream, coords, chunk)
+        return self.log_replay(replay)
+
+    def take_slice(self, replay):
+        coords = []
+        while replay.queue and len(coords) < self.replay_slice:
+            chunk_coords, _ = replay.queue.popitem(last=False)
+            if chunk_coords in self.chunks:
+                coords.append(chunk_coords)
+        return coords
+
+    def log_replay(self, replay):
+        replay.slices += 1
+        elapsed = (time.perf_counter() - replay.start) * 1000
+        if replay.slices == 1:
+            self.upstream.logger.info(
+                "Replayed first chunks in %.1f ms", elapsed)
+        if replay.queue:
+            return True
+        self.upstream.logger.info(
+            "Replayed %d chunks in %.1f ms", replay.count, elapsed)
+        return False
+
+    def send_chunk(self, downstream, coords, chunk):
+        x, z = coords
+        frame = self.get_frame(downstream, chunk)
+        if frame is not None:
+            downstream.send_frame(frame)
+        else:
+            downstream.send_packet(
                 'chunk_data',
-                self.bt.pack('ii?', x, z, True),
-                self.bt.pack_varint(bitmask),
-                self.bt.pack_varint(len(data)),
-                data,
-                self.bt.pack_varint(len(chunk['block_entities'])),
-                *[self.bt.pack_nbt(entity)
-                  for entity in chunk['block_entities'].values()])
-
-            for coords, action in chunk['block_actions'].items():
-                x, y, z = coords
-                block_id, action_id, action_value = action
-
-                if block_id == (self.get_block(x, y, z) >> 4):
-                    self.downstream.send_packet(
-                        'block_action',
-                        self.bt.pack_position(x, y, z),
-                        self.bt.pack('BB', action_id, action_value),
-                        self.bt.pack_varint(block_id))
+                self.get_chunk_packet(x, z, chunk))
+        self.send_block_actions(downstream, chunk)
+
+    def send_block_actions(self, downstream, chunk):
+        for coords, action in chunk['block_actions'].items():
+            x, y, z = coords
+            block_id, action_id, action_value = action
+
+            if block_id == (self.get_chunk_block(chunk, x, y, z) >> 4):
+                downstream.send_packet(
+                    'block_action',
+                    self.bt.pack_position(x, y, z),
+                    self.bt.pack('BB', action_id, action_value),
+                    self.bt.pack_varint(block_id))
+
+    # With a thread pool, each slice of chunks is packed and compressed in
+    # parallel from a snapshot, then written in order on the reactor thread.
+    # Chunks modified while in flight are put back at the front of the queue.
+
+    def encode_slice(self, replay):
+        downstream = replay.downstream
+        ident = downstream.get_packet_ident('chunk_data')
+        threshold = downstream.compression_threshold
+        chunks = []
+        jobs = []
+        for coords in self.take_slice(replay):
+            chunk = self.chunks.peek(coords)
+            chunks.append((coords, chunk))
+            frame = self.get_frame(downstream, chunk)
+            if frame is not None:
+                jobs.append(defer.succeed((chunk['packet'], frame)))
+            else:
+                jobs.append(threads.deferToThreadPool(
+                    reactor, self.pool, self.encode_chunk, coords,
+                    self.snapshot_chunk(chunk), ident, threshold))
+        replay.encoding = dict.fromkeys(
+            (coords for coords, _ in chunks), True)
+
+        d = defer.gatherResults(jobs, consumeErrors=True)
+        d.addCallbacks(
+            self.send_encoded, self.encode_failed,
+            callbackArgs=(replay, chunks), errbackArgs=(replay, chunks))
+
+    def snapshot_chunk(self, chunk):
+        if chunk['packet'] is not None:
+            return {'packet': chunk['packet']}
+        return {
+            'packet': None,
+            'sections': [
+                (section[0].copy(), section[1])
+                if isinstance(section, tuple) else section
+                for section in chunk['sections']],
+            'biomes': chunk['biomes'],
+            'block_entities': self.pack_block_entities(
+                chunk['block_entities'])}
+
+    def encode_chunk(self, coords, snapshot, ident, threshold):
+        # Runs in the thread pool
+        x, z = coords
+        packet = snapshot['packet']
+        if packet is None:
+            packet = self.pack_chunk(x, z, snapshot)
+        return packet, self.bt.pack_packet(
+            self.bt.pack_varint(ident) + packet, threshold)
+
+    def send_encoded(self, results, replay, chunks):
+        if self.replays.get(replay.downstream) is not replay:
+            return
+
+        stale = []
+        downstream = replay.downstream
+        downstream.begin_burst()
+        try:
+            for (coords, chunk), (packet, frame) in zip(chunks, results):
+                current = replay.encoding.get(coords)
+                if current:
+                    if chunk['packet'] is None:
+                        chunk['packet'] = packet
+                    downstream.send_frame(frame)
+                    self.send_block_actions(downstream, chunk)
+                elif current is False:
+                    stale.append(coords)
+        finally:
+            downstream.end_burst()
+        replay.encoding = {}
+
+        for coords in reversed(stale):
+            replay.queue[coords] = None
+            replay.queue.move_to_end(coords, last=False)
+
+        if self.log_replay(replay):
+            self.schedule_replay(replay)
+
+    def encode_failed(self, failure, replay, chunks):
+        # The slice is encoded again on the reactor thread, so the replay
+        # carries on. Chunks that fail again are skipped.
+        self.upstream.logger.error(
+            "Chunk encoding failed, encoding inline: %s",
+            failure.getTraceback())
+        if self.replays.get(replay.downstream) is not replay:
+            return
+
+        downstream = replay.downstream
+        downstream.begin_burst()
+        try:
+            for coords, _ in chunks:
+                if coords not in replay.encoding:
+                    continue
+                try:
+                    self.send_chunk(
+                        downstream, coords, self.chunks.peek(coords))
+                except Exception as e:
+                    self.upstream.logger.exception(e)
+        finally:
+            downstream.end_burst()
+        replay.encoding = {}
+
+        if self.log_replay(replay):
+            self.schedule_replay(replay)
+
+    # Chunks further than the retention radius from the player are paged out
+    # to the region file whenever the player moves into another chunk, and on
+    # respawn. Chunks are only dropped when the server unloads them, as the
+    # radius may be smaller than the server's view distance.
+
+    def get_centre(self):
+        return self.get_plugin(EntitiesPlugin).player.chunk
+
+    def player_changed_chunk(self):
+        self.cull_chunks()
+
+    def cull_chunks(self):
+        centre = self.get_centre()
+        if chunk_retention_radius is None or centre == self.centre:
+            return
+        self.centre = centre
+
+        for coords in list(self.chunks.memory):
+            if max(abs(coords[0] - centre[0]),
+                   abs(coords[1] - centre[1])) > chunk_retention_radius:
+                self.chunks.page_out(coords)
+                self.unprepared.pop(coords, None)
+                self.culled += 1
+
+    def drop_chunk(self, coords):
+        del self.chunks[coords]
+        self.unprepared.pop(coords, None)
+        self.skip_replay(coords)
 
     def packet_downstream_join_game(self, buff):
         self.dimension = buff.unpack('ibi')[2]
         buff.discard()
 
     def packet_downstream_respawn(self, buff):
-        self.dimension = buff.unpack('i')
+        dimension = buff.unpack('i')
         buff.discard()
 
+        # The client discards its world when changing dimension
+        if dimension != self.dimension:
+            for coords in list(self.chunks):
+                self.drop_chunk(coords)
+        self.dimension = dimension
+        self.centre = None
+        self.cull_chunks()
+
     def packet_downstream_chunk_data(self, buff):
+        packet = buff.read()
+        buff = self.bt(packet)
         x, z, contiguous = buff.unpack('ii?')
-        bitmask = buff.unpack_varint()
-        size = buff.unpack_varint()
 
         if contiguous:
-            chunk = self.chunks[x, z] = {
-                'sections': [None] * 16,
-                'block_entities': {},
-                'block_actions': {}}
+            self.chunks[x, z] = self.new_chunk(packet, self.dimension == 0)
+            self.unprepared[x, z] = time.monotonic()
+            self.skip_replay((x, z))
         else:
-            chunk = self.chunks[x, z]
-
-        for idx in range(16):
-            if bitmask & (1 << idx):
-                section = buff.unpack_chunk_section(
-                    self.dimension == 0)
-            elif self.dimension == 0:
-                section = (BlockArray.empty(buff.registry),
-                           LightArray.empty(),
-                           LightArray.empty())
-            else:
-                section = (BlockArray.empty(buff.registry),
-                           LightArray.empty())
+            bitmask = buff.unpack_varint()
+            data = buff.read(buff.unpack_varint())
+            block_entities = buff.read()
 
-            chunk['sections'][idx] = section
-
-        if contiguous:
-            chunk['biomes'] = buff.unpack('I' * 256)
+            chunk = self.chunks[x, z]
+            sections = self.get_sections(chunk)
+            new_sections, _ = self.split_sections(
+                data, bitmask, chunk['overworld'])
+            for idx in range(16):
+                if bitmask & (1 << idx):
+                    sections[idx] = new_sections[idx]
 
-        for _ in range(buff.unpack_varint()):
-            block_entity = buff.unpack_nbt()
-            block_entity_obj = block_entity.to_obj()[""]
-            chunk['block_entities'][
-                block_entity_obj['x'],
-                block_entity_obj['y'],
-                block_entity_obj['z']] = block_entity
+            self.get_block_entities(chunk).update(
+                self.unpack_block_entities(block_entities))
+            self.dirty_chunk((x, z), chunk)
 
     def packet_downstream_unload_chunk(self, buff):
         x, z = buff.unpack('ii')
         if (x, z) in self.chunks:
             del self.chunks[x, z]
+        self.unprepared.pop((x, z), None)
+        self.skip_replay((x, z))
 
     def packet_downstream_block_change(self, buff):
         x, y, z = buff.unpack_position()
-        block = buff.registry.decode_block(buff.unpack_varint())
-        self.set_block(x, y, z, block)
+        self.set_block(x, y, z, buff.unpack_varint())
 
     def packet_downstream_multi_block_change(self, buff):
         chunk_x, chunk_z = buff.unpack('ii')
-        for _ in range(buff.unpack_varint()):
-            block_xz, block_y = buff.unpack('BB')
-            block = buff.registry.decode_block(buff.unpack_varint())
-            self.set_block(
-                16 * chunk_x + block_xz >> 4,
-                block_y,
-                16 * chunk_z + block_xz & 0x0F,
-                block)
+        records = numpy.array(
+            [buff.unpack('BB') + (buff.unpack_varint(),)
+             for _ in range(buff.unpack_varint())],
+            numpy.int64).reshape(-1, 3)
+        block_xz, block_y, block_ids = records.T
+        self.set_blocks(
+            16 * chunk_x + (block_xz >> 4),
+            block_y,
+            16 * chunk_z + (block_xz & 0x0F),
+            block_ids)
 
     def packet_downstream_explosion(self, buff):
         x, y, z, radius = buff.unpack('ffff')
-        for _ in range(buff.unpack('i')):
-            dx, dy, dz = buff.unpack('bbb')
-            self.set_block(x + dx, y + dy, z + dz, 0)
+        records = numpy.frombuffer(
+            buff.read(3 * buff.unpack('i')), numpy.int8).reshape(-1, 3)
+        records = records.astype(numpy.int64)
+        self.set_blocks(
+            int(x) + records[:, 0],
+            int(y) + records[:, 1],
+            int(z) + records[:, 2],
+            0)
         px, py, pz = buff.unpack('fff')
 
     def packet_downstream_update_block_entity(self, buff):
@@ -142,8 +850,9 @@ class WorldPlugin(Plugin):
         new_tag = buff.unpack_nbt()
 
         chunk_x, chunk_z = x // 16, z // 16
-        block_entities = self.chunks[chunk_x, chunk_z][
-            'block_entities']
+        chunk = self.chunks[chunk_x, chunk_z]
+        block_entities = self.get_block_entities(chunk)
+        self.dirty_chunk((chunk_x, chunk_z), chunk)
         old_tag = block_entities.get((x, y, z))
 
         if old_tag and not new_tag:
@@ -1,53 +1,39 @@
-from plugins import Plugin
+from plugins import Plugin, PacketCache, read_varint
 
 
 class WorldBorderPlugin(Plugin):
+    # Fields are as in the "initialize" action: the action, the centre, the
+    # old and new diameters, the speed, the portal teleport boundary, and the
+    # warning time and blocks
+
     def setup(self):
-        self.x = 0
-        self.z = 0
-        self.old_diameter = 0
-        self.new_diameter = 0
-        self.speed = 0
-        self.portal_teleport_boundary = 0
-        self.warning_time = 0
-        self.warning_blocks = 0
+        self.border = PacketCache('world_border')
 
     def attach(self):
-        self.downstream.send_packet(
-            'world_border',
-            self.bt.pack_varint(3),
-            self.bt.pack(
-                'dddd',
-                self.x,
-                self.z,
-                self.old_diameter,
-                self.new_diameter),
-            self.bt.pack_varint(self.speed, max_bits=64),
-            self.bt.pack_varint(self.portal_teleport_boundary),
-            self.bt.pack_varint(self.warning_time),
-            self.bt.pack_varint(self.warning_blocks))
+        self.border.send(self.downstream)
 
     def packet_downstream_world_border(self, buff):
         action = buff.unpack_varint()
         if action == 0:
-            _ = buff.unpack('d')
+            diameter = buff.read(8)
+            self.border.patch(None, 2, diameter + diameter)
+            self.border.patch(None, 3, b"\x00")
         elif action == 1:
-            self.old_diameter = buff.unpack('d')
-            self.new_diameter = buff.unpack('d')
-            self.speed = buff.unpack_varint()
+            self.border.patch(None, 2, buff.read(16))
+            self.border.patch(None, 3, read_varint(buff))
         elif action == 2:
-            self.x = buff.unpack('d')
-            self.z = buff.unpack('d')
+            self.border.patch(None, 1, buff.read(16))
         elif action == 3:
-            self.x = buff.unpack('d')
-            self.z = buff.unpack('d')
-            self.old_diameter = buff.unpack('d')
-            self.new_diameter = buff.unpack('d')
-            self.speed = buff.unpack_varint()
-            self.portal_teleport_boundary = buff.unpack_varint()
-            self.warning_time = buff.unpack_varint()
-            self.warning_blocks = buff.unpack_varint()
+            self.border.set(
+                None,
+                self.bt.pack_varint(3),
+                buff.read(16),
+                buff.read(16),
+                read_varint(buff),
+                read_varint(buff),
+                read_varint(buff),
+                read_varint(buff))
         elif action == 4:
-            self.warning_time = buff.unpack_varint()
+            self.border.patch(None, 5, read_varint(buff))
         elif action == 5:
-            self.warning_blocks = buff.unpack_varint()
+            self.border.patch(None, 6, read_varint(buff))
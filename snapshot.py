@@ -0,0 +1,88 @@
+"""
+Saves and loads the state carried over a hot restart, and tracks the cipher
+state needed to carry on an encrypted connection in another process.
+
+A snapshot is a zlib-compressed pickle of plain data: the listening sockets
+and, for each session in game, its plugins' state and its connection's file
+descriptor, protocol version, compression threshold, cipher state and any
+data received but not yet read. As it holds session keys, it is readable
+only by its owner, and is removed once loaded.
+"""
+
+import os
+import pickle
+import zlib
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import ciphers
+from cryptography.hazmat.primitives.ciphers import algorithms, modes
+from quarry.net.crypto import Cipher
+
+
+magic = b"MBNCSNP1"
+
+
+class ResumableCipher(Cipher):
+    # In CFB8 mode, the state of the cipher after any number of bytes is the
+    # key plus the last 16 bytes of ciphertext, so those are kept for each
+    # direction.
+
+    def enable(self, key):
+        super(ResumableCipher, self).enable(key)
+        self.key = key
+        self.sent = self.received = key
+
+    def disable(self):
+        super(ResumableCipher, self).disable()
+        self.key = None
+
+    def encrypt(self, data):
+        data = super(ResumableCipher, self).encrypt(data)
+        if self.key is not None:
+            self.sent = (self.sent + data[-16:])[-16:]
+        return data
+
+    def decrypt(self, data):
+        if self.key is not None:
+            self.received = (self.received + data[-16:])[-16:]
+        return super(ResumableCipher, self).decrypt(data)
+
+    def get_state(self):
+        if self.key is not None:
+            return self.key, self.sent, self.received
+
+    def resume(self, key, sent, received):
+        self.key, self.sent, self.received = key, sent, received
+        self.encryptor = ciphers.Cipher(
+            algorithms.AES(key), modes.CFB8(sent),
+            backend=default_backend()).encryptor()
+        self.decryptor = ciphers.Cipher(
+            algorithms.AES(key), modes.CFB8(received),
+            backend=default_backend()).decryptor()
+
+
+def save_snapshot(path, snapshot):
+    """
+    Writes a snapshot to a file readable only by its owner, and returns its
+    size in bytes.
+    """
+
+    data = magic + zlib.compress(
+        pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL), 1)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as fd:
+        fd.write(data)
+    return len(data)
+
+
+def load_snapshot(path):
+    """
+    Reads a snapshot, and removes its file.
+    """
+
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    os.remove(path)
+    if data[:len(magic)] != magic:
+        raise ValueError("Not a snapshot: %s" % path)
+    return pickle.loads(zlib.decompress(data[len(magic):]))
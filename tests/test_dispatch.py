@@ -0,0 +1,52 @@
+"""
+Tests for packet dispatch to plugin handlers. Run the tests from the
+repository root, with a ``config.py`` in place, e.g.::
+
+    $ python -m unittest tests.test_dispatch
+"""
+
+import unittest
+
+import minebnc
+from benchmarks import make_upstream
+
+
+class DispatchTest(unittest.TestCase):
+    def setUp(self):
+        # Packets from the client are forwarded through the upstream's own
+        # transport, so they can be checked without a downstream.
+        self.upstream = make_upstream()
+        self.upstream.forwarding = True
+        self.upstream.handlers = {}
+        minebnc.upstream = self.upstream
+
+    def add_handler(self, handler):
+        self.upstream.handlers.setdefault(
+            ("upstream", "keep_alive"), []).append(handler)
+
+    def dispatch(self):
+        buff = self.upstream.buff_type(b"\x00" * 8)
+        self.upstream.transport.clear()
+        self.upstream.dispatch_packet(buff, "keep_alive", "upstream")
+        return self.upstream.transport.value()
+
+    def test_forwarded(self):
+        self.add_handler(lambda buff: buff.discard())
+        self.add_handler(lambda buff: buff.discard() or False)
+        self.assertNotEqual(self.dispatch(), b"")
+
+    def test_handler_stops_forwarding(self):
+        self.add_handler(lambda buff: buff.discard())
+        self.add_handler(lambda buff: buff.discard() or True)
+        self.assertEqual(self.dispatch(), b"")
+
+    def test_later_handlers_still_run(self):
+        seen = []
+        self.add_handler(lambda buff: buff.discard() or True)
+        self.add_handler(lambda buff: seen.append(buff.read()))
+        self.assertEqual(self.dispatch(), b"")
+        self.assertEqual(seen, [b"\x00" * 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
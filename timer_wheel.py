@@ -0,0 +1,253 @@
+"""
+A hierarchical timer wheel that drives the tickers of every connection from
+one reactor callback per tick.
+
+quarry gives each protocol a ticker with its own ``LoopingCall``, which
+checks every task on every tick. Here, tickers keep quarry's interface and
+tick numbering, but file their tasks in a shared wheel by the tick on which
+they are next due, so each tick touches only the tasks that run on it.
+
+The wheel has three levels of 64 slots, spanning 1, 64 and 4096 ticks each,
+and an overflow list for tasks due further ahead. As the wheel turns, the
+slot of each higher level that comes due is cascaded into the level below.
+Delays that are restarted, such as connection timeouts, are not moved when
+restarted; if they come due early they are filed again for their new
+target. Removed tasks and the tasks of stopped tickers are skipped.
+
+Packets sent by the tasks of a tick are written to each connection in one
+burst once the tick is over.
+"""
+
+import logging
+import math
+from time import monotonic
+
+from twisted.internet import task
+from quarry.net.ticker import Ticker, LoopTask, DelayTask
+
+
+class TimerWheel(object):
+    interval = Ticker.interval
+    max_lag = Ticker.max_lag
+    bits = 6
+    levels = 3
+
+    def __init__(self):
+        self.logger = logging.getLogger("TimerWheel")
+        self.tick = 0
+        self.slots = [[[] for _ in range(1 << self.bits)]
+                      for _ in range(self.levels)]
+        self.overflow = []
+        self.stepping = False
+        self.bursts = set()
+        self.call = None
+        self.started = None
+        self.counted = 0
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.max_busy = 0.0
+        self.drift = 0.0
+        self.max_drift = 0.0
+
+    def start(self):
+        if self.call is None:
+            self.call = task.LoopingCall.withCount(self.turn)
+            self.call.start(self.interval, now=False)
+            self.started = monotonic()
+
+    def insert(self, due, item):
+        delta = due - self.tick
+        mask = (1 << self.bits) - 1
+        if delta <= mask:
+            self.slots[0][due & mask].append((due, item))
+            return
+        for level in range(1, self.levels):
+            shift = self.bits * level
+            if delta < 1 << (shift + self.bits):
+                self.slots[level][(due >> shift) & mask].append((due, item))
+                return
+        self.overflow.append((due, item))
+
+    def turn(self, count):
+        # Called by the reactor with the number of intervals since last time
+        start = monotonic()
+        self.counted += count
+        self.drift = start - self.started - self.counted * self.interval
+        self.max_drift = max(self.max_drift, self.drift)
+        if count > 1:
+            self.overruns += 1
+        if count >= self.max_lag:
+            self.logger.warning("Can't keep up! Skipping %d ticks", count - 1)
+            self.skipped += count - 1
+            count = 1
+
+        self.stepping = True
+        try:
+            for _ in range(count):
+                self.step()
+        finally:
+            self.stepping = False
+            for protocol in self.bursts:
+                protocol.end_burst()
+            self.bursts.clear()
+
+        busy = monotonic() - start
+        self.busy += busy
+        self.max_busy = max(self.max_busy, busy)
+
+    def step(self):
+        now = self.tick
+        mask = (1 << self.bits) - 1
+
+        # Cascade the slots coming due, from the highest level down
+        if now & ((1 << self.bits * self.levels) - 1) == 0:
+            entries, self.overflow = self.overflow, []
+            for due, item in entries:
+                self.insert(due, item)
+        for level in range(self.levels - 1, 0, -1):
+            shift = self.bits * level
+            if now & ((1 << shift) - 1) == 0:
+                slots = self.slots[level]
+                entries, slots[(now >> shift) & mask] = \
+                    slots[(now >> shift) & mask], []
+                for due, item in entries:
+                    self.insert(due, item)
+
+        # Run the tasks due now, grouped by ticker
+        slots = self.slots[0]
+        entries, slots[now & mask] = slots[now & mask], []
+        tickers = {}
+        for due, item in entries:
+            if item.due == due:
+                tickers.setdefault(item.ticker, []).append(item)
+        for ticker, tasks in tickers.items():
+            ticker.run(tasks)
+        self.tick += 1
+        self.ticks += 1
+
+    def get_stats(self):
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "busy": self.busy,
+            "max_busy": self.max_busy,
+            "drift": self.drift,
+            "max_drift": self.max_drift}
+
+    def describe(self):
+        return (
+            "ticker: %d ticks, %d overruns, %d skipped; "
+            "busy: %.2f ms/tick (max %.1f ms); drift: %.1f ms (max %.1f ms)"
+            % (self.ticks, self.overruns, self.skipped,
+               1000 * self.busy / max(self.ticks, 1), 1000 * self.max_busy,
+               1000 * self.drift, 1000 * self.max_drift))
+
+
+wheel = TimerWheel()
+
+
+class WheelTicker(Ticker):
+    # A quarry ticker whose tasks are run by the shared wheel. While running,
+    # its tick is the wheel's less an offset. Packets sent by its tasks are
+    # written in a burst if its protocol is set.
+
+    wheel = wheel
+    protocol = None
+
+    def __init__(self, logger):
+        self.offset = 0
+        self.stopped_tick = 0
+        super(WheelTicker, self).__init__(logger)
+
+    @property
+    def tick(self):
+        if self.running:
+            return self.wheel.tick - self.offset
+        return self.stopped_tick
+
+    def start(self):
+        if not self.running:
+            self.offset = self.wheel.tick - self.stopped_tick
+            self.running = True
+            self.wheel.start()
+            for entry in self._tasks:
+                self.schedule(entry)
+
+    def stop(self):
+        if self.running:
+            self.stopped_tick = self.tick
+            self.running = False
+            for entry in self._tasks:
+                entry.due = None
+
+    def add_loop(self, interval, callback):
+        task = LoopTask(self, interval, self._wrap(callback))
+        return self.add_task(task)
+
+    def add_delay(self, delay, callback):
+        task = DelayTask(self, delay, self._wrap(callback))
+        return self.add_task(task)
+
+    def add_task(self, task):
+        task.due = None
+        self._tasks.append(task)
+        self.schedule(task)
+        return task
+
+    def remove(self, task):
+        self._tasks.remove(task)
+        task.due = None
+
+    def remove_all(self):
+        for entry in self._tasks:
+            entry.due = None
+        del self._tasks[:]
+
+    def schedule(self, task, tick=None):
+        # Files a task in the wheel for the given tick, or for its next run
+        if not self.running:
+            return
+        earliest = self.tick + (1 if self.wheel.stepping else 0)
+        if tick is None:
+            if isinstance(task, LoopTask):
+                tick = earliest + (-earliest) % task.interval
+            else:
+                tick = int(math.ceil(task.target))
+        due = self.offset + max(tick, earliest)
+        if task.due != due:
+            task.due = due
+            self.wheel.insert(due, task)
+
+    def run(self, tasks):
+        # Runs this ticker's tasks that are due on the current tick
+        protocol = self.protocol
+        if protocol is not None and protocol not in self.wheel.bursts:
+            protocol.begin_burst()
+            self.wheel.bursts.add(protocol)
+        for entry in tasks:
+            self.fire(entry)
+
+    def fire(self, task):
+        wheel = self.wheel
+        if task.due != wheel.tick:
+            # Removed or stopped by an earlier task
+            return
+        if isinstance(task, LoopTask):
+            task.due += task.interval
+            wheel.insert(task.due, task)
+            task.callback()
+            return
+
+        task.due = None
+        if self.tick < task.target:
+            # Restarted since it was filed
+            return self.schedule(task)
+        task.callback()
+        if task in self._tasks:
+            self.remove(task)